@@ -1,50 +1,82 @@
 import os
+import json
+import time
 import sqlite3
 import uuid
 import threading
-from flask import Flask, request, render_template, redirect, url_for, send_from_directory
-from worker import process_jobs
+import importlib.util
+from flask import Flask, Response, g, request, render_template, redirect, url_for, send_from_directory, jsonify
+import archive
+import jobstore
+import metrics
+import storage
 
 # --- Configuration ---
 UPLOAD_FOLDER = 'uploads'
 OUTPUT_FOLDER = 'outputs'
-DATABASE = 'jobs.db'
-ALLOWED_EXTENSIONS = {'xlsx'}
+DATABASE = jobstore.DATABASE
+ALLOWED_EXTENSIONS = {'xlsx', 'csv'}
+# pyarrow is optional; without it a Parquet upload would only fail in the worker
+if importlib.util.find_spec('pyarrow') is not None:
+    ALLOWED_EXTENSIONS.add('parquet')
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['OUTPUT_FOLDER'] = OUTPUT_FOLDER
 
-# Worker state tracking
-worker_running = False
+# Server-Sent Events: how often a stream checks for new lines and for
+# progress (a GROUP BY over the job's rows, so less often), and how long it
+# stays open before the browser is told to reconnect (which it does
+# transparently, resuming from Last-Event-ID).
+SSE_POLL_INTERVAL = float(os.environ.get('SSE_POLL_INTERVAL', '2'))
+SSE_PROGRESS_INTERVAL = float(os.environ.get('SSE_PROGRESS_INTERVAL', '10'))
+SSE_MAX_SECONDS = int(os.environ.get('SSE_MAX_SECONDS', '300'))
+SSE_KEEPALIVE_SECONDS = 15
+
+# Run a queue worker thread inside each web process unless dedicated
+# worker processes (python worker.py) are used instead. The web tier itself
+# only needs jobstore; the scrape/render stack (worker and everything it
+# imports) is loaded when the embedded worker starts, never otherwise.
+EMBEDDED_WORKER = os.environ.get('EMBEDDED_WORKER', '1') == '1'
+_embedded_worker = None
+_embedded_worker_lock = threading.Lock()
 
 # --- Database Helpers ---
 def get_db():
-    try:
-        db = sqlite3.connect(DATABASE)
-        db.row_factory = sqlite3.Row
-        return db
-    except sqlite3.Error as e:
-        raise RuntimeError(f"Database connection failed: {e}")
+    """One connection per request, closed by close_connection at teardown."""
+    db = getattr(g, '_database', None)
+    if db is None:
+        try:
+            db = g._database = jobstore.connect()
+        except sqlite3.Error as e:
+            raise RuntimeError(f"Database connection failed: {e}")
+    return db
 
 def init_db():
-    with app.app_context():
-        db = get_db()
-        with app.open_resource('schema.sql', mode='r') as f:
-            db.cursor().executescript(f.read())
-        # Add logs column if it doesn't exist
-        try:
-            db.execute('ALTER TABLE jobs ADD COLUMN logs TEXT DEFAULT ""')
-        except sqlite3.OperationalError:
-            pass  # Column already exists
-        db.commit()
+    # Idempotent: creates missing tables/columns on existing databases too
+    db = jobstore.connect()
+    jobstore.init_schema(db)
+    db.close()
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(Flask, '_database', None)
+    db = g.pop('_database', None)
     if db is not None:
         db.close()
 
+# --- Embedded Worker ---
+@app.before_request
+def start_embedded_worker():
+    global _embedded_worker
+    if not EMBEDDED_WORKER or _embedded_worker is not None:
+        return
+    with _embedded_worker_lock:
+        if _embedded_worker is None:
+            from worker import main_worker_loop
+            # Claims are atomic, so one of these per gunicorn worker is safe
+            _embedded_worker = threading.Thread(target=main_worker_loop, daemon=True, name='embedded-worker')
+            _embedded_worker.start()
+
 # --- File Helpers ---
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -61,23 +93,17 @@ def upload_page():
         
         if file:
             job_id = str(uuid.uuid4())
-            filename = f"{job_id}.xlsx"
+            ext = file.filename.rsplit('.', 1)[1].lower()  # The worker picks a reader by extension
+            filename = f"{job_id}.{ext}"
             filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
             # Validate path to prevent traversal
             if not os.path.abspath(filepath).startswith(os.path.abspath(app.config['UPLOAD_FOLDER'])):
                 return "Invalid file path", 400
             file.save(filepath)
             
+            mode = 'preview' if request.form.get('mode') == 'preview' else 'full'
             db = get_db()
-            db.execute('INSERT INTO jobs (id, status, input_file) VALUES (?, ?, ?)', 
-                       (job_id, 'PENDING', filepath))
-            db.commit()
-            
-            # Start worker in background thread if not already running
-            global worker_running
-            if not worker_running:
-                worker_running = True
-                threading.Thread(target=process_jobs, daemon=True).start()
+            jobstore.submit_job(db, job_id, filepath, mode)  # Also wakes an idle worker
             
             return redirect(url_for('status_page', job_id=job_id))
             
@@ -86,39 +112,235 @@ def upload_page():
 @app.route('/status/<job_id>')
 def status_page(job_id):
     db = get_db()
-    job = db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    job = db.execute('SELECT id, status, output_file, logs, mode, preview_of, expired_at FROM jobs WHERE id = ?', (job_id,)).fetchone()
     
     if not job:
         return "Job not found", 404
-        
-    return render_template('index.html', job=job)
+    
+    # Jobs from before the job_logs table keep their lines in jobs.logs
+    lines = [line for line in (job['logs'] or '').split('\n') if line.strip()]
+    log_rows = jobstore.read_job_logs(db, job_id)
+    lines += [jobstore.format_log_line(row) for row in log_rows]
+    videos = sorted(jobstore.completed_rows(db, job_id))
+    return render_template('index.html', job=job, log_lines=lines, videos=videos,
+                           last_log_id=log_rows[-1]['id'] if log_rows else 0)
+
+@app.route('/status/<job_id>/logs')
+def status_logs(job_id):
+    """New log lines since ?after=<id>, for incremental polling."""
+    after_id = request.args.get('after', 0, type=int)
+    rows = jobstore.read_job_logs(get_db(), job_id, after_id)
+    return jsonify({
+        'lines': [jobstore.format_log_line(row) for row in rows],
+        'next': rows[-1]['id'] if rows else after_id,
+    })
+
+@app.route('/status/<job_id>/progress')
+def status_progress(job_id):
+    """Row counters and ETA as JSON."""
+    progress = jobstore.job_progress(get_db(), job_id)
+    if progress is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(progress)
+
+@app.route('/status/<job_id>/events')
+def status_events(job_id):
+    """Server-Sent Events stream of new log lines and progress changes."""
+    if jobstore.job_progress(get_db(), job_id) is None:
+        return "Job not found", 404
+    after_id = request.headers.get('Last-Event-ID', request.args.get('after', 0), type=int)
+    return Response(
+        sse_stream(job_id, after_id),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def sse_event(event, data, event_id=None):
+    lines = [f"event: {event}"]
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"data: {data}")
+    return '\n'.join(lines) + '\n\n'
+
+def sse_stream(job_id, after_id):
+    # Runs after the request has ended, so it keeps its own connection
+    db = jobstore.connect()
+    try:
+        yield "retry: 3000\n\n"
+        last_state = None
+        next_progress = 0
+        last_sent = started = time.time()
+        while time.time() - started < SSE_MAX_SECONDS:
+            for row in jobstore.read_job_logs(db, job_id, after_id):
+                after_id = row['id']
+                last_sent = time.time()
+                yield sse_event('log', jobstore.format_log_line(row), after_id)
+            if time.time() >= next_progress:
+                next_progress = time.time() + SSE_PROGRESS_INTERVAL
+                progress = jobstore.job_progress(db, job_id)
+                # The ETA moves with the clock; only new counts or a new status are sent
+                state = {key: value for key, value in progress.items() if key != 'eta_seconds'}
+                if state != last_state:
+                    last_state = state
+                    last_sent = time.time()
+                    yield sse_event('progress', json.dumps(progress))
+                if progress['status'] in ('COMPLETED', 'FAILED'):
+                    # Lines flushed just before the status changed
+                    for row in jobstore.read_job_logs(db, job_id, after_id):
+                        after_id = row['id']
+                        yield sse_event('log', jobstore.format_log_line(row), after_id)
+                    yield sse_event('end', progress['status'])
+                    return
+            if time.time() - last_sent > SSE_KEEPALIVE_SECONDS:
+                last_sent = time.time()
+                yield ": keepalive\n\n"
+            time.sleep(SSE_POLL_INTERVAL)
+    finally:
+        db.close()
+
+@app.route('/status/<job_id>/timings')
+def status_timings(job_id):
+    """Per-stage timing totals for one job, to see where a slow job spent its time."""
+    return jsonify(jobstore.job_timings(get_db(), job_id))
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Stage timing histograms, queue depth and throughput in Prometheus text format."""
+    db = get_db()
+    jobs, rows = jobstore.queue_counts(db)
+    lines = metrics.histogram_lines(
+        'video_stage_seconds', 'Time spent per row in each pipeline stage.',
+        [(f'stage="{stage}"', count, total, cumulative)
+         for stage, count, total, cumulative in jobstore.stage_histograms(db, metrics.BUCKETS)])
+    lines += metrics.sample_lines(
+        'video_jobs', 'gauge', 'Jobs by status; PENDING is the queue depth.',
+        [(f'status="{status}"', jobs.get(status, 0)) for status in ('PENDING', 'PROCESSING', 'COMPLETED', 'FAILED')])
+    lines += metrics.sample_lines(
+        'video_rows_total', 'counter', 'Rows finished, by outcome.',
+        [(f'status="{status}"', rows.get(status, 0)) for status in ('DONE', 'FAILED')])
+    report = storage.report()
+    lines += metrics.sample_lines(
+        'video_storage_bytes', 'gauge', 'Bytes on disk by area as of the last storage pass, each file counted once.',
+        [(f'area="{area}"', size) for area, size in report['areas'].items()])
+    lines += metrics.sample_lines(
+        'video_storage_quota_bytes', 'gauge', 'Disk budget for all areas together.', [('', report['quota_bytes'])])
+    lines += metrics.sample_lines(
+        'video_disk_free_bytes', 'gauge', 'Free space on the data volume.', [('', report['disk']['free'])])
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+@app.route('/storage')
+def storage_report():
+    """Disk usage by area (as of the last storage pass), quota and retention settings, and how many jobs have expired."""
+    report = storage.report()
+    report['expired_jobs'] = jobstore.expired_count(get_db())
+    return jsonify(report)
+
+@app.route('/retry/<job_id>', methods=['POST'])
+def retry_job(job_id):
+    """Requeue a failed job; rows that already have a video are kept."""
+    if not jobstore.retry_job(get_db(), job_id):
+        return "Only failed jobs can be retried.", 409
+    return redirect(url_for('status_page', job_id=job_id))
+
+@app.route('/promote/<job_id>', methods=['POST'])
+def promote_job(job_id):
+    """Queue the full render of a finished preview, reusing its scraped profiles."""
+    new_job_id = str(uuid.uuid4())
+    if not jobstore.promote_job(get_db(), job_id, new_job_id):
+        return "Only completed preview jobs can be promoted.", 409
+    return redirect(url_for('status_page', job_id=new_job_id))
 
 @app.route('/download/<job_id>')
 def download_zip(job_id):
+    """ZIP of every video finished so far, built while it is sent."""
     try:
         db = get_db()
-        job = db.execute('SELECT * FROM jobs WHERE id = ? AND status = ?', (job_id, 'COMPLETED')).fetchone()
+        job = db.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
         
         if not job:
             return "Job not ready or not found.", 404
+        if job['expired_at']:
+            return "This job's files have expired.", 410
+
+        # Jobs finished before streaming downloads have a prebuilt archive
+        if job['output_file'] and job['output_file'].endswith('.zip'):
+            jobstore.mark_downloaded(db, job_id)
+            return send_from_directory(
+                app.config['OUTPUT_FOLDER'],
+                os.path.basename(job['output_file']),
+                as_attachment=True
+            )
+
+        videos = jobstore.completed_rows(db, job_id)
+        if not videos:
+            return "Job not ready or not found.", 404
+        jobstore.mark_downloaded(db, job_id)
+        return Response(
+            timed_zip(job_id, archive.video_entries(videos)),
+            mimetype='application/zip',
+            headers={'Content-Disposition': f'attachment; filename={job_id}.zip'}
+        )
+    except (sqlite3.Error, FileNotFoundError, OSError) as e:
+        return f"Download failed: {str(e)}", 500
+
+def timed_zip(job_id, entries):
+    """stream_zip, recording how long a complete download took as the job's zip stage."""
+    start = time.perf_counter()
+    yield from archive.stream_zip(entries)
+    db = jobstore.connect()
+    try:
+        jobstore.insert_timings(db, job_id, None, [('zip', time.perf_counter() - start)])
+        db.commit()
+    except sqlite3.Error as e:
+        print(f"Timing record error: {e}")
+    finally:
+        db.close()
 
+@app.route('/download/<job_id>/<int:row>')
+def download_video(job_id, row):
+    """A single row's video (or preview image), as soon as that row is done."""
+    try:
+        db = get_db()
+        job = db.execute('SELECT expired_at FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if job and job['expired_at']:
+            return "This job's files have expired.", 410
+        path = jobstore.completed_row(db, job_id, row)
+        if not path:
+            return "Video not ready or not found.", 404
+        is_preview = path.endswith('.jpg')
+        if not is_preview:
+            jobstore.mark_downloaded(db, job_id)  # Viewing previews doesn't keep a job from expiring
         return send_from_directory(
-            app.config['OUTPUT_FOLDER'],
-            os.path.basename(job['output_file']),
-            as_attachment=True
+            os.path.dirname(os.path.abspath(path)),
+            os.path.basename(path),
+            as_attachment=not is_preview  # Previews open in the browser
         )
     except (sqlite3.Error, FileNotFoundError, OSError) as e:
         return f"Download failed: {str(e)}", 500
 
+@app.route('/preview/<job_id>/<int:row>')
+def preview_image(job_id, row):
+    """A preview row's contact sheet, for the status page gallery.
+
+    Read-only: one row lookup and one stat per image, and viewing the
+    gallery doesn't count as using the job for retention.
+    """
+    try:
+        path = jobstore.completed_row(get_db(), job_id, row)
+        if not path or not path.endswith('.jpg'):
+            return "Preview not ready or not found.", 404
+        return send_from_directory(os.path.dirname(os.path.abspath(path)), os.path.basename(path))
+    except (sqlite3.Error, FileNotFoundError, OSError) as e:
+        return f"Preview failed: {str(e)}", 500
+
+# Bring the schema up to date however the app is started (gunicorn, passenger, python app.py)
+init_db()
+
 if __name__ == '__main__':
     # Ensure directories exist
     os.makedirs(UPLOAD_FOLDER, exist_ok=True)
     os.makedirs(OUTPUT_FOLDER, exist_ok=True)
     
-    # Initialize DB if missing
-    if not os.path.exists(DATABASE):
-        init_db()
-        
     port = int(os.environ.get('PORT', 5000))
     host = '0.0.0.0' if os.environ.get('PORT') else '127.0.0.1'
     app.run(host=host, port=port)
\ No newline at end of file
@@ -0,0 +1,44 @@
+import os
+import zipfile
+
+# --- Configuration ---
+CHUNK_SIZE = 256 * 1024
+
+class _Sink:
+    """Write-only buffer. ZipFile sees it can't seek and writes data descriptors instead."""
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+def stream_zip(files):
+    """Yield a ZIP archive of files, given as (path, name in archive) pairs, chunk by chunk.
+
+    Entries are stored uncompressed: the videos are already compressed, so
+    deflating them costs CPU for no gain. Nothing is written to disk and the
+    first bytes go out before the last file has been read.
+    """
+    sink = _Sink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as zf:
+        for path, arcname in files:
+            info = zipfile.ZipInfo.from_file(path, arcname)
+            info.compress_type = zipfile.ZIP_STORED
+            with open(path, 'rb') as src, zf.open(info, 'w') as dst:
+                for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                    dst.write(chunk)
+                    yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()  # Central directory
+
+def video_entries(videos):
+    """(path, arcname) pairs for {row_index: path}, in row order."""
+    return [(videos[index], os.path.basename(videos[index])) for index in sorted(videos)]
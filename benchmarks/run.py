@@ -0,0 +1,286 @@
+"""Offline benchmark for the scrape, render, encode and zip stages.
+
+Profile pages are served from benchmarks/fixtures by a local HTTP server and
+Format 2 sheets of each requested size are generated on the fly, so runs
+need no network and are comparable between machines and commits.
+
+    python benchmarks/run.py                          # 10, 100 and 1000 rows
+    python benchmarks/run.py --rows 10 --output before.json
+    python benchmarks/run.py --baseline before.json   # exit 1 on regressions
+
+Results are JSON: per sheet size, each stage's sample count and timings in
+seconds (total, mean, p50, p95, min, max).
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURE_DIR = os.path.join(ROOT, 'benchmarks', 'fixtures')
+WORK_DIR = tempfile.mkdtemp(prefix='bench_')
+
+# Caches must start empty and stay out of the real cache dirs; the modules
+# read these at import time.
+os.environ['PAGE_CACHE_DIR'] = os.path.join(WORK_DIR, 'cache', 'pages')
+os.environ['MEDIA_CACHE_DIR'] = os.path.join(WORK_DIR, 'cache', 'media')
+os.environ['AUDIO_CACHE_DIR'] = os.path.join(WORK_DIR, 'cache', 'audio')
+os.environ['VIDEO_CACHE_DIR'] = os.path.join(WORK_DIR, 'cache', 'videos')
+os.environ['RENDER_CACHE'] = '0'
+
+os.chdir(ROOT)  # video_generator finds its assets relative to the repo
+sys.path.insert(0, ROOT)
+
+from openpyxl import Workbook
+from PIL import Image
+
+import archive
+import scraper
+import video_generator
+from sheet_reader import read_sheet
+from worker import build_format2_profile
+
+DEFAULT_ROWS = [10, 100, 1000]
+
+# --- Fixture Server ---
+class FixtureHandler(SimpleHTTPRequestHandler):
+    """/profile/<n>/ serves fixture n (mod the number of fixtures); /pic.jpg the test photo."""
+    pages = []
+    picture = b''
+
+    def do_GET(self):
+        if self.path == '/pic.jpg':
+            body, content_type = self.picture, 'image/jpeg'
+        elif self.path.startswith('/profile/'):
+            n = int(self.path.strip('/').split('/')[-1])
+            body, content_type = self.pages[n % len(self.pages)], 'text/html; charset=utf-8'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    FixtureHandler.pages = [
+        open(os.path.join(FIXTURE_DIR, name), encoding='utf-8').read().replace('{base}', base).encode('utf-8')
+        for name in sorted(os.listdir(FIXTURE_DIR)) if name.endswith('.html')
+    ]
+    pic_path = os.path.join(WORK_DIR, 'pic.jpg')
+    gradient = Image.linear_gradient('L').resize((600, 600)).convert('RGB')
+    gradient.save(pic_path, quality=90)
+    with open(pic_path, 'rb') as f:
+        FixtureHandler.picture = f.read()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, base
+
+# --- Timing ---
+def summarize(samples):
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+    def pct(p):
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+    return {
+        'count': len(samples),
+        'total': round(sum(samples), 6),
+        'mean': round(sum(samples) / len(samples), 6),
+        'p50': round(pct(0.5), 6),
+        'p95': round(pct(0.95), 6),
+        'min': round(ordered[0], 6),
+        'max': round(ordered[-1], 6),
+    }
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+# --- Stages ---
+def write_sheet(path, rows, base):
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(["Profile Name", "Age", "Marital Status", "Mother Toungue", "Religion", "Country",
+               "Education", "Occupation", "Profile description", "Photos URL", "Background music URL"])
+    for i in range(rows):
+        ws.append([f"Profile {i}", 22 + i % 20, "Never Married", "Hindi", "Hindu", "India",
+                   "Masters", "Analyst", f"Synthetic profile number {i} for benchmarking.",
+                   f"{base}/pic.jpg", None])
+    wb.save(path)
+
+def bench_ingest(sheet_path):
+    """Stream the sheet and build every Format 2 profile."""
+    start = time.perf_counter()
+    _, _, rows = read_sheet(sheet_path)
+    profiles = [build_format2_profile(row) for _, row in rows]
+    return [time.perf_counter() - start], profiles
+
+def bench_scrape(base, rows):
+    """get_profile_data per URL, first against an empty page cache, then warm."""
+    cold, warm = [], []
+    urls = [f"{base}/profile/{i}/" for i in range(rows)]
+    shutil.rmtree(os.environ['PAGE_CACHE_DIR'], ignore_errors=True)
+    for samples in (cold, warm):
+        for url in urls:
+            elapsed, profile = timed(scraper.get_profile_data, url)
+            if profile is None:
+                raise RuntimeError(f"fixture did not parse: {url}")
+            samples.append(elapsed)
+    start = time.perf_counter()
+    shutil.rmtree(os.environ['PAGE_CACHE_DIR'], ignore_errors=True)
+    for _ in scraper.get_profiles_data(urls):
+        pass
+    return cold, warm, [time.perf_counter() - start]
+
+def bench_scenes(profiles, samples):
+    """create_scene_image for all four scenes of the first profiles."""
+    times = []
+    scene_dir = os.path.join(WORK_DIR, 'scenes')
+    os.makedirs(scene_dir, exist_ok=True)
+    for profile in profiles[:samples]:
+        media = video_generator.download_media(profile)
+        avatar = video_generator.load_avatar(media['picture'])
+        for scene in range(1, 5):
+            elapsed, path = timed(video_generator.create_scene_image, profile, scene, scene_dir, avatar)
+            if not path:
+                raise RuntimeError("scene render failed")
+            times.append(elapsed)
+    return times
+
+def bench_encode(profiles, samples):
+    """The ffmpeg stitching step of generate_video_from_profile, on pre-rendered frames."""
+    times, videos = [], []
+    out_dir = os.path.join(WORK_DIR, 'videos')
+    os.makedirs(out_dir, exist_ok=True)
+    music = video_generator.DEFAULT_AUDIO
+    shutil.rmtree(os.environ['AUDIO_CACHE_DIR'], ignore_errors=True)
+    audio_time, _ = timed(video_generator.prepare_audio_track, music)
+    for i, profile in enumerate(profiles[:samples]):
+        media = video_generator.download_media(profile)
+        avatar = video_generator.load_avatar(media['picture'])
+        frames = [video_generator.render_scene(profile, scene, avatar) for scene in range(1, 5)]
+        output = os.path.join(out_dir, f"video_{i}.mp4")
+        elapsed, _ = timed(quiet, video_generator.stitch_frames, frames, music, output)
+        times.append(elapsed)
+        videos.append(output)
+    return [audio_time], times, videos
+
+def bench_zip(video, rows):
+    """Stream a ZIP of one video per row, as /download/<job_id> does."""
+    job_dir = os.path.join(WORK_DIR, 'zip_job')
+    shutil.rmtree(job_dir, ignore_errors=True)
+    os.makedirs(job_dir)
+    videos = {}
+    for i in range(rows):
+        videos[i] = os.path.join(job_dir, f"video_{i}.mp4")
+        os.link(video, videos[i])
+    start = time.perf_counter()
+    size = sum(len(chunk) for chunk in archive.stream_zip(archive.video_entries(videos)))
+    return [time.perf_counter() - start], size
+
+def quiet(fn, *args):
+    """Run fn with ffmpeg's stderr chatter sent to /dev/null."""
+    saved = os.dup(2)
+    try:
+        with open(os.devnull, 'w') as devnull:
+            os.dup2(devnull.fileno(), 2)
+            return fn(*args)
+    finally:
+        os.dup2(saved, 2)
+        os.close(saved)
+
+# --- Runner ---
+def run(rows_list, scene_samples, encode_samples):
+    server, base = start_server()
+    results = {'meta': run_metadata(), 'sizes': {}}
+    try:
+        for rows in rows_list:
+            print(f"Benchmarking {rows} rows...", file=sys.stderr)
+            sheet = os.path.join(WORK_DIR, f"sheet_{rows}.xlsx")
+            write_sheet(sheet, rows, base)
+            ingest, profiles = bench_ingest(sheet)
+            scrape_cold, scrape_warm, scrape_batch = bench_scrape(base, rows)
+            scenes = bench_scenes(profiles, scene_samples)
+            audio, encode, videos = bench_encode(profiles, encode_samples)
+            zip_time, zip_bytes = bench_zip(videos[0], rows)
+            results['sizes'][str(rows)] = {
+                'ingest': summarize(ingest),
+                'scrape': summarize(scrape_cold),
+                'scrape_cached': summarize(scrape_warm),
+                'scrape_batch': summarize(scrape_batch),
+                'scene': summarize(scenes),
+                'audio_prepare': summarize(audio),
+                'encode': summarize(encode),
+                'zip': dict(summarize(zip_time), bytes=zip_bytes),
+            }
+    finally:
+        server.shutdown()
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+    return results
+
+def run_metadata():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'parser': scraper.PARSER,
+        'pipe_frames': video_generator.PIPE_FRAMES,
+        'segments': video_generator.SEGMENT_ENCODE,
+    }
+
+def compare(results, baseline, tolerance):
+    """Stages whose mean got more than tolerance slower than in baseline."""
+    regressions = []
+    for rows, stages in results['sizes'].items():
+        for stage, stats in stages.items():
+            before = baseline.get('sizes', {}).get(rows, {}).get(stage, {})
+            if stats.get('count') and before.get('mean'):
+                ratio = stats['mean'] / before['mean']
+                if ratio > 1 + tolerance:
+                    regressions.append(f"{rows} rows / {stage}: {before['mean']:.4f}s -> {stats['mean']:.4f}s ({ratio:.2f}x)")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the video pipeline offline.")
+    parser.add_argument('--rows', type=int, nargs='+', default=DEFAULT_ROWS, help="sheet sizes to benchmark")
+    parser.add_argument('--scene-samples', type=int, default=5, help="profiles whose scenes are timed per size")
+    parser.add_argument('--encode-samples', type=int, default=2, help="videos encoded per size (at least 1)")
+    parser.add_argument('--output', help="write results JSON here instead of stdout")
+    parser.add_argument('--baseline', help="results JSON from an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown before a stage counts as regressed")
+    args = parser.parse_args()
+
+    results = run(args.rows, args.scene_samples, max(1, args.encode_samples))
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,179 @@
+import os
+import time
+import random
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# --- Configuration ---
+DEFAULT_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
+POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '16'))  # Keep-alive connections per host
+PER_HOST_LIMIT = int(os.environ.get('HTTP_PER_HOST_LIMIT', '4'))  # Concurrent requests per host
+CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '5'))  # Seconds
+READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', '20'))       # Seconds between bytes
+MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', '2'))            # After the first attempt
+BACKOFF_BASE = float(os.environ.get('HTTP_BACKOFF_BASE', '0.5'))      # Seconds, doubled per retry, jittered
+ROW_DEADLINE = float(os.environ.get('HTTP_ROW_DEADLINE', '60'))       # Seconds of fetching per row and stage
+BREAKER_THRESHOLD = int(os.environ.get('HTTP_BREAKER_THRESHOLD', '5'))   # Consecutive failures that trip a host
+BREAKER_COOLDOWN = float(os.environ.get('HTTP_BREAKER_COOLDOWN', '30'))  # Seconds a tripped host is skipped
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_session = None
+_session_lock = threading.Lock()
+_host_slots = {}
+_host_slots_lock = threading.Lock()
+_breakers = {}  # host -> {'failures': consecutive failures, 'open_until': unix time}
+_breakers_lock = threading.Lock()
+_local = threading.local()
+
+class CircuitOpenError(requests.ConnectionError):
+    """Raised without contacting a host that has been failing."""
+
+class DeadlineExceeded(requests.Timeout):
+    """Raised once the current row has used up its fetch time."""
+
+def get_session():
+    """Process-wide Session so repeat requests reuse TCP/TLS connections."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.headers.update(DEFAULT_HEADERS)
+                _session = session
+    return _session
+
+@contextmanager
+def host_slot(url):
+    """Block until fewer than PER_HOST_LIMIT requests are in flight to url's host."""
+    host = urlparse(url).netloc
+    with _host_slots_lock:
+        slot = _host_slots.get(host)
+        if slot is None:
+            slot = _host_slots[host] = threading.BoundedSemaphore(PER_HOST_LIMIT)
+    with slot:
+        yield
+
+# --- Deadlines ---
+# Fetch code for one row runs inside deadline(); every request it makes, and
+# every retry and backoff, has to fit in what is left of that budget.
+
+@contextmanager
+def deadline(seconds=ROW_DEADLINE):
+    """Limit the total time this thread's requests may take inside the block."""
+    outer = getattr(_local, 'deadline', None)
+    limit = time.time() + seconds
+    _local.deadline = limit if outer is None else min(outer, limit)
+    try:
+        yield
+    finally:
+        _local.deadline = outer
+
+def time_left():
+    """Seconds left before the current deadline, or None outside deadline()."""
+    limit = getattr(_local, 'deadline', None)
+    return None if limit is None else limit - time.time()
+
+def check_deadline():
+    left = time_left()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded("fetch deadline for this row exceeded")
+
+def iter_body(resp, chunk_size):
+    """Yield a streamed response's body, stopping when the row's deadline passes.
+
+    Reads whatever has arrived (up to chunk_size) rather than waiting for a
+    full chunk, so a host trickling bytes just fast enough to dodge the read
+    timeout is still cut off on time.
+    """
+    read1 = getattr(resp.raw, 'read1', None)
+    if read1 is None:  # urllib3 1.x: deadline checked per full chunk only
+        for chunk in resp.iter_content(chunk_size):
+            check_deadline()
+            yield chunk
+        return
+    while True:
+        check_deadline()
+        chunk = read1(chunk_size, decode_content=True)
+        if not chunk:
+            return
+        yield chunk
+
+# --- Circuit Breaker ---
+# After BREAKER_THRESHOLD failures in a row (connection errors, timeouts,
+# 429/5xx) a host is failed fast for BREAKER_COOLDOWN seconds. Then one
+# request is let through as a probe: success closes the circuit, failure
+# opens it for another cooldown.
+
+def _before_request(host):
+    with _breakers_lock:
+        state = _breakers.get(host)
+        if state is None or state['failures'] < BREAKER_THRESHOLD:
+            return
+        now = time.time()
+        if now < state['open_until']:
+            raise CircuitOpenError(f"{host} is failing; skipped for another {state['open_until'] - now:.0f}s")
+        state['open_until'] = now + BREAKER_COOLDOWN  # This request is the probe; others keep failing fast
+
+def _record_result(host, ok):
+    with _breakers_lock:
+        state = _breakers.setdefault(host, {'failures': 0, 'open_until': 0.0})
+        if ok:
+            state['failures'] = 0
+            return
+        state['failures'] += 1
+        if state['failures'] >= BREAKER_THRESHOLD:
+            state['open_until'] = time.time() + BREAKER_COOLDOWN
+            if state['failures'] == BREAKER_THRESHOLD:
+                print(f"Circuit open for {host} after {BREAKER_THRESHOLD} consecutive failures")
+
+# --- Requests ---
+def _timeout_within(timeout, left):
+    connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+    return (min(connect, left), min(read, left))
+
+def _backoff(attempt):
+    """Full-jitter exponential backoff, cut short by the deadline."""
+    delay = random.uniform(0, BACKOFF_BASE * 2 ** attempt)
+    left = time_left()
+    if left is not None:
+        delay = min(delay, max(left, 0))
+    time.sleep(delay)
+
+def get(url, **kwargs):
+    """GET with timeouts, jittered retries and the host's circuit breaker.
+
+    Connection errors, timeouts and 429/5xx responses are retried up to
+    MAX_RETRIES times; the last retryable response is returned as-is so the
+    caller's raise_for_status() reports it. Raises CircuitOpenError for a
+    host that is being skipped and DeadlineExceeded when the row's time is up.
+    """
+    host = urlparse(url).netloc
+    timeout = kwargs.pop('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    for attempt in range(MAX_RETRIES + 1):
+        check_deadline()
+        _before_request(host)
+        left = time_left()
+        try:
+            with host_slot(url):
+                resp = get_session().get(
+                    url, timeout=timeout if left is None else _timeout_within(timeout, left), **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            _record_result(host, False)
+            if attempt == MAX_RETRIES:
+                raise
+        else:
+            if resp.status_code not in RETRY_STATUSES:
+                _record_result(host, True)
+                return resp
+            _record_result(host, False)
+            if attempt == MAX_RETRIES:
+                return resp
+            resp.close()
+        _backoff(attempt)
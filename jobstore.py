@@ -0,0 +1,473 @@
+import os
+import json
+import atexit
+import sqlite3
+import datetime
+import time
+import threading
+
+import metrics
+
+# --- Configuration ---
+DATABASE = 'jobs.db'
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql')
+BUSY_TIMEOUT = float(os.environ.get('DB_BUSY_TIMEOUT', '10'))  # Seconds to wait on a locked database
+LOG_FLUSH_INTERVAL = float(os.environ.get('LOG_FLUSH_INTERVAL', '0.5'))  # Seconds
+LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', '120'))  # Claim lifetime without a heartbeat
+MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '3'))      # Claims before a crashing job is failed
+WAKE_FILE = os.environ.get('QUEUE_WAKE_FILE', 'queue.wake')
+
+def connect(check_same_thread=True):
+    db = sqlite3.connect(DATABASE, timeout=BUSY_TIMEOUT, check_same_thread=check_same_thread)
+    db.row_factory = sqlite3.Row
+    # WAL lets status/download reads proceed while a worker is writing, and
+    # NORMAL sync is durable enough there (a crash can only lose the last
+    # few log lines) while avoiding an fsync per commit.
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute('PRAGMA synchronous=NORMAL')
+    return db
+
+# Columns added after a table's first release; CREATE TABLE IF NOT EXISTS
+# won't add them to an existing database.
+JOB_COLUMNS = [
+    ('logs', 'TEXT DEFAULT ""'),
+    ('claimed_by', 'TEXT'),
+    ('lease_expires_at', 'REAL'),
+    ('attempts', 'INTEGER NOT NULL DEFAULT 0'),
+    ('total_rows', 'INTEGER'),
+    ('started_at', 'REAL'),
+    ('mode', "TEXT NOT NULL DEFAULT 'full'"),
+    ('preview_of', 'TEXT'),
+    ('last_downloaded_at', 'REAL'),
+    ('expired_at', 'REAL'),
+]
+ROW_COLUMNS = [
+    ('profile', 'TEXT'),
+]
+
+def init_schema(db):
+    """Create any missing tables and columns. Safe to run on every start."""
+    for table, columns in (('jobs', JOB_COLUMNS), ('job_rows', ROW_COLUMNS)):
+        for column, definition in columns:
+            try:
+                db.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+            except sqlite3.OperationalError:
+                pass  # Column already exists (or the table doesn't yet)
+    had_totals = db.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stage_buckets'").fetchone()
+    with open(SCHEMA_FILE, 'r') as f:
+        db.executescript(f.read())
+    if not had_totals:
+        backfill_totals(db)
+    db.commit()
+
+# --- Job Queue ---
+# Any number of worker processes share the jobs table as a queue. A worker
+# claims a job inside a write transaction, so two workers can never claim the
+# same row, and holds it under a lease it renews with heartbeats. A job whose
+# lease ran out (its worker died) is handed to the next worker that asks.
+
+def submit_job(db, job_id, input_file, mode='full', preview_of=None):
+    """Queue a job. mode is 'full' (videos) or 'preview' (contact sheets only)."""
+    db.execute(
+        'INSERT INTO jobs (id, status, input_file, mode, preview_of) VALUES (?, ?, ?, ?, ?)',
+        (job_id, 'PENDING', input_file, mode, preview_of))
+    db.commit()
+    notify_workers()
+
+def promote_job(db, preview_id, job_id):
+    """Queue job_id as the full render of a finished preview job.
+
+    The new job reads the same sheet but takes each row's profile from the
+    preview instead of scraping it again. Returns False if preview_id is not
+    a COMPLETED preview.
+    """
+    preview = db.execute(
+        "SELECT input_file FROM jobs WHERE id = ? AND mode = 'preview' AND status = 'COMPLETED' "
+        "AND expired_at IS NULL", (preview_id,)).fetchone()
+    if preview is None:
+        return False
+    submit_job(db, job_id, preview['input_file'], 'full', preview_id)
+    return True
+
+def claim_job(db, worker_id, min_wait=0):
+    """Atomically claim the oldest runnable job. Returns the job row or None.
+
+    With min_wait, only pending jobs queued at least that many seconds ago
+    are taken.
+    """
+    now = time.time()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        # Jobs that keep killing their workers are given up on
+        db.execute(
+            "UPDATE jobs SET status = 'FAILED', claimed_by = NULL, lease_expires_at = NULL "
+            "WHERE status = 'PROCESSING' AND attempts >= ? "
+            "AND (lease_expires_at IS NULL OR lease_expires_at < ?)", (MAX_ATTEMPTS, now))
+        job = db.execute(
+            "SELECT * FROM jobs WHERE (status = 'PENDING' AND created_at <= datetime(?, 'unixepoch')) "
+            "OR (status = 'PROCESSING' AND (lease_expires_at IS NULL OR lease_expires_at < ?)) "
+            "ORDER BY created_at LIMIT 1", (now - min_wait, now)).fetchone()
+        if job:
+            db.execute(
+                "UPDATE jobs SET status = 'PROCESSING', claimed_by = ?, lease_expires_at = ?, "
+                "attempts = attempts + 1, started_at = ? WHERE id = ?",
+                (worker_id, now + LEASE_SECONDS, now, job['id']))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return job
+
+def renew_lease(db, job_id, worker_id):
+    """Extend our lease. Returns False if the job is no longer ours."""
+    cur = db.execute(
+        'UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND claimed_by = ?',
+        (time.time() + LEASE_SECONDS, job_id, worker_id))
+    db.commit()
+    return cur.rowcount == 1
+
+def finish_job(db, job_id, worker_id, status, output_file):
+    db.execute(
+        'UPDATE jobs SET status = ?, output_file = ?, claimed_by = NULL, lease_expires_at = NULL '
+        'WHERE id = ? AND claimed_by = ?', (status, output_file, job_id, worker_id))
+    db.commit()
+
+def retry_job(db, job_id):
+    """Requeue a FAILED job. Rows that already have a video are not redone."""
+    cur = db.execute(
+        "UPDATE jobs SET status = 'PENDING', attempts = 0, claimed_by = NULL, lease_expires_at = NULL "
+        "WHERE id = ? AND status = 'FAILED' AND expired_at IS NULL", (job_id,))
+    db.commit()
+    if cur.rowcount:
+        notify_workers()
+    return cur.rowcount == 1
+
+class LeaseKeeper:
+    """Heartbeat thread that renews a job's lease while it is being processed.
+
+    lost is set once the job may have been handed to another worker: a
+    renewal found it claimed by someone else, or renewals kept failing until
+    the lease ran out. The job's processing should stop taking on rows then.
+    """
+    def __init__(self, job_id, worker_id, interval=LEASE_SECONDS / 4):
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.lost = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True, name=f'lease-{job_id}')
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        db = connect()
+        renewed_at = time.time()
+        try:
+            while not self.stopped.wait(self.interval):
+                try:
+                    if not renew_lease(db, self.job_id, self.worker_id):
+                        print(f"Lost lease on job {self.job_id}")
+                        self.lost.set()
+                        return
+                    renewed_at = time.time()
+                except sqlite3.Error as e:
+                    print(f"Heartbeat error for job {self.job_id}: {e}")
+                    if time.time() - renewed_at >= LEASE_SECONDS:
+                        print(f"Lease on job {self.job_id} expired without a heartbeat")
+                        self.lost.set()
+                        return
+        finally:
+            db.close()
+
+def notify_workers():
+    """Wake idle workers now instead of at their next poll."""
+    try:
+        with open(WAKE_FILE, 'a'):
+            os.utime(WAKE_FILE)
+    except OSError as e:
+        print(f"Could not signal workers: {e}")
+
+def wait_for_work(timeout):
+    """Sleep up to timeout seconds, returning early if notify_workers() is called."""
+    def wake_stamp():
+        try:
+            return os.stat(WAKE_FILE).st_mtime_ns
+        except OSError:
+            return None
+    start = wake_stamp()
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        time.sleep(0.2)
+        if wake_stamp() != start:
+            return
+
+# --- Row Checkpoints ---
+# Each finished row is recorded as soon as its video is written, so a job
+# that is resumed (after a crash, redeploy or retry) only redoes rows that
+# failed or never ran.
+
+def record_row(job_id, row_index, status, output_path=None, error=None, timings=(), profile=None):
+    """Record a row's outcome, its (stage, seconds) timings and the profile it was rendered from.
+
+    Opens its own connection so it can be called from pool callbacks.
+    """
+    db = connect()
+    try:
+        db.execute(
+            'INSERT OR REPLACE INTO job_rows (job_id, row_index, status, output_path, error, updated_at, profile) '
+            'VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP, ?)',
+            (job_id, row_index, status, output_path, error, json.dumps(profile) if profile else None))
+        insert_timings(db, job_id, row_index, timings)
+        db.execute(
+            'INSERT INTO row_outcomes (status, count) VALUES (?, 1) '
+            'ON CONFLICT (status) DO UPDATE SET count = count + 1', (status,))
+        db.commit()
+    except sqlite3.Error as e:
+        print(f"Row checkpoint error: {e}")
+    finally:
+        db.close()
+
+def set_total_rows(db, job_id, total):
+    db.execute('UPDATE jobs SET total_rows = ? WHERE id = ?', (total, job_id))
+    db.commit()
+
+def job_progress(db, job_id):
+    """Row counters and an ETA for a job, or None if there is no such job.
+
+    The ETA is projected from the rows finished since the current run
+    started, so rows carried over from an earlier attempt don't skew it.
+    """
+    job = db.execute(
+        'SELECT status, total_rows, started_at FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    if job is None:
+        return None
+    counts = {'DONE': 0, 'FAILED': 0}
+    this_run = 0
+    for row in db.execute(
+            "SELECT status, COUNT(*) AS n, SUM(CAST(strftime('%s', updated_at) AS REAL) >= ?) AS recent "
+            "FROM job_rows WHERE job_id = ? GROUP BY status", (int(job['started_at'] or 0), job_id)):
+        counts[row['status']] = row['n']
+        this_run += row['recent'] or 0
+    total = job['total_rows']
+    eta = None
+    if job['status'] == 'PROCESSING' and total and this_run and job['started_at']:
+        remaining = max(total - counts['DONE'] - counts['FAILED'], 0)
+        eta = round((time.time() - job['started_at']) / this_run * remaining)
+    return {
+        'status': job['status'],
+        'total': total,
+        'done': counts['DONE'],
+        'failed': counts['FAILED'],
+        'eta_seconds': eta,
+    }
+
+def completed_rows(db, job_id):
+    """{row_index: output_path} for rows whose video is still on disk."""
+    done = {}
+    for row in db.execute(
+            "SELECT row_index, output_path FROM job_rows WHERE job_id = ? AND status = 'DONE'", (job_id,)):
+        path = row['output_path']
+        if path and os.path.exists(path) and os.path.getsize(path) > 0:
+            done[row['row_index']] = path
+    return done
+
+def completed_row(db, job_id, row_index):
+    """One row's output path if the row is done and its file still on disk, else None."""
+    row = db.execute(
+        "SELECT output_path FROM job_rows WHERE job_id = ? AND row_index = ? AND status = 'DONE'",
+        (job_id, row_index)).fetchone()
+    path = row['output_path'] if row else None
+    if path and os.path.exists(path) and os.path.getsize(path) > 0:
+        return path
+    return None
+
+def row_profiles(db, job_id):
+    """{row_index: profile} for every row of a job whose profile was recorded."""
+    return {
+        row['row_index']: json.loads(row['profile'])
+        for row in db.execute(
+            'SELECT row_index, profile FROM job_rows WHERE job_id = ? AND profile IS NOT NULL', (job_id,))
+    }
+
+# --- Stage Timings ---
+# Every timing is kept in stage_timings for the per-job breakdown, and also
+# added to stage_buckets: a count and total per stage and histogram bucket,
+# which is all /metrics reads. row_outcomes does the same for row results.
+
+def bucket_bound(seconds):
+    """Upper bound of the histogram bucket a timing falls in (inf past the last one)."""
+    return next((float(le) for le in metrics.BUCKETS if seconds <= le), float('inf'))
+
+def insert_timings(db, job_id, row_index, timings):
+    db.executemany(
+        'INSERT INTO stage_timings (job_id, row_index, stage, seconds) VALUES (?, ?, ?, ?)',
+        [(job_id, row_index, stage, seconds) for stage, seconds in timings])
+    db.executemany(
+        'INSERT INTO stage_buckets (stage, le, count, total) VALUES (?, ?, 1, ?) '
+        'ON CONFLICT (stage, le) DO UPDATE SET count = count + 1, total = total + excluded.total',
+        [(stage, bucket_bound(seconds), seconds) for stage, seconds in timings])
+
+def backfill_totals(db):
+    """Fill the running totals from the history, for databases that predate them."""
+    cases = ' '.join(f'WHEN seconds <= {float(le)!r} THEN {float(le)!r}' for le in metrics.BUCKETS)
+    db.execute(
+        f'INSERT INTO stage_buckets (stage, le, count, total) '
+        f'SELECT stage, CASE {cases} ELSE 9e999 END AS bound, COUNT(*), SUM(seconds) '
+        f'FROM stage_timings GROUP BY stage, bound')
+    db.execute('INSERT INTO row_outcomes (status, count) SELECT status, COUNT(*) FROM job_rows GROUP BY status')
+
+def job_timings(db, job_id):
+    """Per-stage count, total and mean seconds for one job."""
+    return {
+        row['stage']: {'count': row['n'], 'total': round(row['total'], 3), 'mean': round(row['total'] / row['n'], 3)}
+        for row in db.execute(
+            'SELECT stage, COUNT(*) AS n, SUM(seconds) AS total FROM stage_timings '
+            'WHERE job_id = ? GROUP BY stage', (job_id,))
+    }
+
+def stage_histograms(db, buckets):
+    """(stage, count, sum, [cumulative count per bucket]) across all jobs."""
+    bucket_sums = ', '.join(f'SUM(CASE WHEN le <= {float(le)!r} THEN count ELSE 0 END)' for le in buckets)
+    return [
+        (row[0], row[1], row[2], list(row[3:]))
+        for row in db.execute(
+            f'SELECT stage, SUM(count), SUM(total), {bucket_sums} FROM stage_buckets GROUP BY stage ORDER BY stage')
+    ]
+
+def queue_counts(db):
+    """{status: number of jobs} and {row status: number of row outcomes ever recorded}."""
+    jobs = {row[0]: row[1] for row in db.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status')}
+    rows = {row[0]: row[1] for row in db.execute('SELECT status, count FROM row_outcomes')}
+    return jobs, rows
+
+# --- Retention ---
+# Finished jobs are expired (their files deleted, the row kept) least
+# recently downloaded first; see storage.py.
+
+DOWNLOAD_STAMP_INTERVAL = 3600  # Retention is counted in days; an hour-old stamp is close enough
+
+def mark_downloaded(db, job_id):
+    """Stamp a job as used now, unless it already was within the last DOWNLOAD_STAMP_INTERVAL."""
+    now = time.time()
+    # Read first, so repeat downloads don't each take the write lock
+    row = db.execute('SELECT last_downloaded_at FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    if row is None or (row['last_downloaded_at'] or 0) > now - DOWNLOAD_STAMP_INTERVAL:
+        return
+    db.execute('UPDATE jobs SET last_downloaded_at = ? WHERE id = ?', (now, job_id))
+    db.commit()
+
+def expirable_jobs(db):
+    """Finished, unexpired jobs, least recently used first.
+
+    A job that was never downloaded counts as used when it last started.
+    """
+    return db.execute(
+        "SELECT id, input_file, output_file, COALESCE(last_downloaded_at, started_at, 0) AS last_used "
+        "FROM jobs WHERE status IN ('COMPLETED', 'FAILED') AND expired_at IS NULL "
+        "ORDER BY last_used").fetchall()
+
+def input_shared(db, job_id, input_file):
+    """True if another unexpired job (a promoted preview) reads the same upload."""
+    return db.execute(
+        'SELECT 1 FROM jobs WHERE input_file = ? AND id != ? AND expired_at IS NULL LIMIT 1',
+        (input_file, job_id)).fetchone() is not None
+
+def mark_expired(db, job_id):
+    """Mark a finished job expired. False if it already was or is no longer finished.
+
+    Called before its files are deleted: once this commits, /retry refuses
+    the job, and a job /retry requeued first is left alone.
+    """
+    cur = db.execute(
+        "UPDATE jobs SET expired_at = ? WHERE id = ? AND status IN ('COMPLETED', 'FAILED') "
+        "AND expired_at IS NULL", (time.time(), job_id))
+    if cur.rowcount:
+        # Its timings live on in the /metrics totals
+        db.execute('DELETE FROM stage_timings WHERE job_id = ?', (job_id,))
+    db.commit()
+    return cur.rowcount == 1
+
+def claim_storage_pass(db, interval):
+    """True if no storage pass started in the last interval seconds; this caller then runs one."""
+    now = time.time()
+    cur = db.execute('UPDATE storage_passes SET started_at = ? WHERE id = 1 AND started_at <= ?',
+                     (now, now - interval))
+    db.commit()
+    return cur.rowcount == 1
+
+def expired_count(db):
+    return db.execute('SELECT COUNT(*) FROM jobs WHERE expired_at IS NOT NULL').fetchone()[0]
+
+# --- Job Logs ---
+# Log lines are appended to the job_logs table rather than rewriting the
+# jobs.logs column. Writers buffer lines in memory and a background thread
+# inserts them in one transaction every LOG_FLUSH_INTERVAL.
+
+class JobLogWriter:
+    def __init__(self, flush_interval=LOG_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.lock = threading.Lock()        # Guards pending
+        self.flush_lock = threading.Lock()  # Serialises writes so lines stay in order
+        self.db = None
+        self.thread = None
+
+    def append(self, job_id, message):
+        logged_at = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.lock:
+            self.pending.append((job_id, logged_at, message))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True, name='job-log-flusher')
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """Write all buffered lines now. Called periodically and at job end."""
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, []
+            if not batch:
+                return
+            try:
+                if self.db is None:
+                    self.db = connect(check_same_thread=False)
+                    init_schema(self.db)
+                self.db.executemany(
+                    'INSERT INTO job_logs (job_id, logged_at, message) VALUES (?, ?, ?)', batch)
+                self.db.commit()
+            except sqlite3.Error as e:
+                print(f"Log update error: {e}")
+                with self.lock:
+                    self.pending = batch + self.pending  # Retry on the next flush
+
+_log_writer = JobLogWriter()
+atexit.register(_log_writer.flush)
+
+def append_job_log(job_id, message):
+    _log_writer.append(job_id, message)
+
+def flush_job_logs():
+    _log_writer.flush()
+
+def read_job_logs(db, job_id, after_id=0):
+    """Log rows for a job with id > after_id, oldest first.
+
+    Pass the id of the last row you have seen to read only new lines.
+    """
+    return db.execute(
+        'SELECT id, logged_at, message FROM job_logs WHERE job_id = ? AND id > ? ORDER BY id',
+        (job_id, after_id)).fetchall()
+
+def format_log_line(row):
+    return f"[{row['logged_at'][-8:]}] {row['message']}"
@@ -0,0 +1,178 @@
+import os
+import time
+import hashlib
+import threading
+from urllib.parse import urlparse
+
+import http_client
+
+# --- Configuration ---
+CACHE_DIR = os.environ.get('MEDIA_CACHE_DIR', os.path.join('cache', 'media'))
+BLOB_DIR = os.path.join(CACHE_DIR, 'blobs')   # <sha256 of content><ext>
+URL_DIR = os.path.join(CACHE_DIR, 'urls')     # <sha256 of url> -> blob name
+MAX_ASSET_BYTES = int(os.environ.get('MEDIA_MAX_ASSET_BYTES', str(50 * 1024 * 1024)))
+CACHE_MAX_BYTES = int(os.environ.get('MEDIA_CACHE_MAX_BYTES', str(2 * 1024 * 1024 * 1024)))
+CHUNK_SIZE = 256 * 1024
+LOCK_STALE_SECONDS = 300   # A fetch lock older than this belongs to a dead worker
+MIN_EVICT_AGE = 900        # Never evict blobs used this recently (may still be rendering)
+
+_url_locks = {}
+_url_locks_lock = threading.Lock()
+
+def _url_key(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+def _extension(url):
+    ext = os.path.splitext(urlparse(url).path)[1].lower()
+    return ext if ext[1:].isalnum() and len(ext) <= 6 else ''
+
+def _lookup(key):
+    try:
+        with open(os.path.join(URL_DIR, key), 'r') as f:
+            blob_path = os.path.join(BLOB_DIR, f.read().strip())
+    except OSError:
+        return None
+    if not os.path.exists(blob_path):
+        return None
+    try:
+        os.utime(blob_path)  # Mark as recently used for LRU eviction
+    except OSError:
+        pass
+    return blob_path
+
+def _thread_lock(key):
+    with _url_locks_lock:
+        lock = _url_locks.get(key)
+        if lock is None:
+            lock = _url_locks[key] = threading.Lock()
+        return lock
+
+def fetch(url):
+    """Return a local path holding the content at url, downloading it at most once.
+
+    Downloads are shared across rows, jobs and worker processes. If another
+    worker is already fetching the same URL we wait for its result instead of
+    downloading it twice. Returns None if the download fails or is too large.
+    """
+    if not url:
+        return None
+    key = _url_key(url)
+    path = _lookup(key)
+    if path:
+        return path
+
+    # One thread per process, then one process per machine (via a lock file)
+    with _thread_lock(key):
+        path = _lookup(key)
+        if path:
+            return path
+        os.makedirs(URL_DIR, exist_ok=True)
+        os.makedirs(BLOB_DIR, exist_ok=True)
+        lock_path = os.path.join(URL_DIR, key + '.lock')
+        while True:
+            try:
+                os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                path = _wait_for_other_worker(key, lock_path)
+                if path:
+                    return path
+        try:
+            return _download(url, key)
+        finally:
+            try:
+                os.remove(lock_path)
+            except OSError:
+                pass
+
+def _wait_for_other_worker(key, lock_path):
+    while True:
+        path = _lookup(key)
+        if path:
+            return path
+        try:
+            if time.time() - os.path.getmtime(lock_path) > LOCK_STALE_SECONDS:
+                os.remove(lock_path)
+                return None
+        except OSError:
+            return None  # Lock released without a result; try ourselves
+        time.sleep(0.2)
+
+def _download(url, key):
+    tmp_path = os.path.join(BLOB_DIR, f"{key}.{os.getpid()}.{threading.get_ident()}.part")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with http_client.get(url, stream=True) as resp:
+            resp.raise_for_status()
+            with open(tmp_path, 'wb') as f:
+                for chunk in http_client.iter_body(resp, CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > MAX_ASSET_BYTES:
+                        raise ValueError(f"asset larger than {MAX_ASSET_BYTES} bytes")
+                    digest.update(chunk)
+                    f.write(chunk)
+        blob_name = digest.hexdigest() + _extension(url)
+        blob_path = os.path.join(BLOB_DIR, blob_name)
+        if os.path.exists(blob_path):
+            os.remove(tmp_path)  # Same content already cached under another URL
+            os.utime(blob_path)
+        else:
+            os.replace(tmp_path, blob_path)
+        index_tmp = os.path.join(URL_DIR, f"{key}.{os.getpid()}.tmp")
+        with open(index_tmp, 'w') as f:
+            f.write(blob_name)
+        os.replace(index_tmp, os.path.join(URL_DIR, key))
+    except Exception as e:
+        print(f"Media download failed for {url}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
+    evict()
+    return blob_path
+
+def content_hash(path):
+    """Content identity of a cached blob (its file name) or of any other file."""
+    if os.path.dirname(os.path.abspath(path)) == os.path.abspath(BLOB_DIR):
+        return os.path.splitext(os.path.basename(path))[0]
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def evict():
+    """Remove least recently used blobs while the cache is over CACHE_MAX_BYTES.
+
+    URL entries left pointing at a removed blob are treated as misses.
+    """
+    evict_lru(BLOB_DIR, CACHE_MAX_BYTES)
+
+def evict_lru(directory, max_bytes, min_age=MIN_EVICT_AGE):
+    """Delete the oldest-mtime files in directory until it is under 90% of max_bytes.
+
+    Files touched within min_age seconds are kept even if that leaves the
+    directory over its cap, since a render may still be reading them.
+    """
+    files = []
+    for name in os.listdir(directory):
+        if name.endswith(('.part', '.tmp')):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        files.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in files)
+    if total <= max_bytes:
+        return
+    now = time.time()
+    for mtime, size, path in sorted(files):
+        if total <= max_bytes * 0.9 or now - mtime < min_age:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
@@ -0,0 +1,58 @@
+import time
+import threading
+from contextlib import contextmanager
+
+# --- Configuration ---
+# Upper bounds (seconds) of the histogram buckets exposed at /metrics
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+_local = threading.local()
+
+# --- Recording ---
+# Code being measured wraps each stage in timer(); whoever owns the row wraps
+# the call in collect() to get the (stage, seconds) pairs recorded by this
+# thread while it ran. Timings recorded outside any collect() are dropped.
+
+@contextmanager
+def timer(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+def record(stage, seconds):
+    sink = getattr(_local, 'sink', None)
+    if sink is not None:
+        sink.append((stage, seconds))
+
+@contextmanager
+def collect():
+    """Capture the timings recorded by this thread inside the block."""
+    outer = getattr(_local, 'sink', None)
+    captured = _local.sink = []
+    try:
+        yield captured
+    finally:
+        _local.sink = outer
+        if outer is not None:
+            outer.extend(captured)
+
+# --- Prometheus Exposition ---
+def histogram_lines(name, help_text, rows):
+    """Text-format histogram. rows: (label, count, sum, [cumulative count per bucket])."""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for label, count, total, cumulative in rows:
+        for le, n in zip(BUCKETS, cumulative):
+            lines.append(f'{name}_bucket{{{label},le="{le}"}} {n}')
+        lines.append(f'{name}_bucket{{{label},le="+Inf"}} {count}')
+        lines.append(f'{name}_sum{{{label}}} {total:.6f}')
+        lines.append(f'{name}_count{{{label}}} {count}')
+    return lines
+
+def sample_lines(name, metric_type, help_text, samples):
+    """Text-format gauge or counter. samples: (label or '', value)."""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    for label, value in samples:
+        lines.append(f"{name}{{{label}}} {value}" if label else f"{name} {value}")
+    return lines
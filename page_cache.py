@@ -0,0 +1,133 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+# --- Configuration ---
+CACHE_DIR = os.environ.get('PAGE_CACHE_DIR', os.path.join('cache', 'pages'))
+CACHE_TTL = int(os.environ.get('PAGE_CACHE_TTL', str(6 * 3600)))  # Seconds before revalidating
+CACHE_MAX_BYTES = int(os.environ.get('PAGE_CACHE_MAX_BYTES', str(100 * 1024 * 1024)))
+
+_lock = threading.Lock()
+_stats = {'hits': 0, 'revalidated': 0, 'misses': 0}
+_local = threading.local()  # Outcome of this thread's last lookup, for per-job counts
+_total_bytes = None
+
+def _entry_path(url):
+    return os.path.join(CACHE_DIR, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+
+def _count(key):
+    with _lock:
+        _stats[key] += 1
+    _local.outcome = key
+
+def stats():
+    with _lock:
+        return dict(_stats)
+
+def take_outcome():
+    """'hits', 'revalidated' or 'misses' for this thread's last lookup (None if it failed), then clear it."""
+    outcome = getattr(_local, 'outcome', None)
+    _local.outcome = None
+    return outcome
+
+def load(url):
+    """Return the cached entry for url, or None."""
+    try:
+        with open(_entry_path(url), 'r', encoding='utf-8') as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return entry if entry.get('url') == url else None
+
+def is_fresh(entry):
+    return entry is not None and time.time() - entry.get('fetched_at', 0) < CACHE_TTL
+
+def conditional_headers(entry):
+    headers = {}
+    if entry:
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+def hit(entry):
+    _count('hits')
+    try:
+        os.utime(_entry_path(entry['url']))  # Keep recently used entries from eviction
+    except OSError:
+        pass
+    return entry['profile']
+
+def revalidated(entry):
+    """Server answered 304: restart the TTL and reuse the cached profile."""
+    _count('revalidated')
+    entry['fetched_at'] = time.time()
+    _write(entry)
+    return entry['profile']
+
+def save(url, profile, response):
+    _count('misses')
+    if profile is None:
+        return  # Don't cache pages we couldn't parse
+    _write({
+        'url': url,
+        'fetched_at': time.time(),
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'profile': profile,
+    })
+
+def _write(entry):
+    global _total_bytes
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    path = _entry_path(entry['url'])
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(entry, f)
+    size = os.path.getsize(tmp_path)
+    os.replace(tmp_path, path)  # Atomic, so concurrent workers never see half an entry
+    with _lock:
+        if _total_bytes is None:
+            _total_bytes = _dir_size()
+        else:
+            _total_bytes += size
+        over = _total_bytes > CACHE_MAX_BYTES
+    if over:
+        evict()
+
+def _dir_size():
+    total = 0
+    for name in os.listdir(CACHE_DIR):
+        try:
+            total += os.path.getsize(os.path.join(CACHE_DIR, name))
+        except OSError:
+            pass
+    return total
+
+def evict():
+    """Drop least recently used entries until the cache is under 90% of its cap."""
+    global _total_bytes
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    target = CACHE_MAX_BYTES * 0.9
+    for _, size, path in entries:
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+    with _lock:
+        _total_bytes = total
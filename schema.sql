@@ -4,5 +4,72 @@ CREATE TABLE IF NOT EXISTS jobs (
   input_file TEXT NOT NULL,
   output_file TEXT,
   logs TEXT DEFAULT '',
-  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
\ No newline at end of file
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  claimed_by TEXT,
+  lease_expires_at REAL,
+  attempts INTEGER NOT NULL DEFAULT 0,
+  total_rows INTEGER,
+  started_at REAL,
+  mode TEXT NOT NULL DEFAULT 'full',
+  preview_of TEXT,
+  last_downloaded_at REAL,
+  expired_at REAL
+);
+
+CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs (status, created_at);
+
+CREATE TABLE IF NOT EXISTS job_logs (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  job_id TEXT NOT NULL,
+  logged_at TIMESTAMP NOT NULL,
+  message TEXT NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_job_logs_job_id ON job_logs (job_id, id);
+
+CREATE TABLE IF NOT EXISTS job_rows (
+  job_id TEXT NOT NULL,
+  row_index INTEGER NOT NULL,
+  status TEXT NOT NULL CHECK(status IN ('DONE', 'FAILED')),
+  output_path TEXT,
+  error TEXT,
+  updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  profile TEXT,
+  PRIMARY KEY (job_id, row_index)
+);
+
+CREATE TABLE IF NOT EXISTS stage_timings (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  job_id TEXT NOT NULL,
+  row_index INTEGER,
+  stage TEXT NOT NULL,
+  seconds REAL NOT NULL,
+  recorded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_stage_timings_job_id ON stage_timings (job_id);
+
+-- Running totals behind /metrics, kept up to date as timings and rows are
+-- recorded so a scrape never scans the history above
+CREATE TABLE IF NOT EXISTS stage_buckets (
+  stage TEXT NOT NULL,
+  le REAL NOT NULL,
+  count INTEGER NOT NULL,
+  total REAL NOT NULL,
+  PRIMARY KEY (stage, le)
+);
+
+CREATE TABLE IF NOT EXISTS row_outcomes (
+  status TEXT PRIMARY KEY,
+  count INTEGER NOT NULL
+);
+
+-- When the last storage maintenance pass started. Every worker process runs
+-- the maintenance loop; claiming this row makes only one of them do a pass
+-- per interval.
+CREATE TABLE IF NOT EXISTS storage_passes (
+  id INTEGER PRIMARY KEY CHECK (id = 1),
+  started_at REAL NOT NULL
+);
+
+INSERT OR IGNORE INTO storage_passes (id, started_at) VALUES (1, 0);
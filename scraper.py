@@ -1,10 +1,31 @@
-import requests
-from bs4 import BeautifulSoup
+import os
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from bs4 import BeautifulSoup, SoupStrainer
 import re
 
+import http_client
+import metrics
+import page_cache
+
+SCRAPE_THREADS = int(os.environ.get('SCRAPE_THREADS', '8'))
+# 'lxml' is several times faster than the pure-Python 'html.parser' but can
+# build a different tree for badly broken markup, so it is opt-in.
+PARSER = os.environ.get('SCRAPER_PARSER', 'html.parser')
+# Nothing we extract lives in <head>, so by default it is never built. <html>
+# is rejected too so that <body> and any stray tags after it are kept as
+# separate top-level subtrees, exactly as a full parse would find them.
+SKIP_HEAD = os.environ.get('SCRAPER_SKIP_HEAD', '1') == '1'
+HEAD_TAGS = {'html', 'head', 'title', 'meta', 'link', 'base', 'script', 'style', 'noscript'}
+
+def _outside_head(name, attrs=None):
+    return name not in HEAD_TAGS
+
+NO_HEAD = SoupStrainer(_outside_head)
+
 # --- Helper Logic ---
 
-def extract_name(soup, text):
+def extract_name(soup):
     # Try text-shadow style (specific to this site)
     for h3 in soup.find_all('h3'):
         if 'text-shadow' in h3.get('style', ''):
@@ -18,24 +39,33 @@ def extract_name(soup, text):
             if 2 < len(name) < 50: return name
     return "N/A"
 
-def extract_field_from_iconbox(soup, keyword):
-    """Generic extractor for the icon-leftbox structure"""
+def build_iconbox_index(soup):
+    """Walk the icon-leftbox blocks once into (label, box text) pairs in page order.
+
+    Every field extractor below reads from this list instead of searching the
+    whole tree again.
+    """
+    index = []
     for box in soup.find_all('div', class_='icon-leftbox'):
         strong = box.find('strong')
-        if strong and keyword in strong.get_text():
-            return box.get_text().replace(strong.get_text(), '').strip()
+        if strong:
+            index.append((strong.get_text(), box.get_text()))
+    return index
+
+def extract_field_from_iconbox(index, keyword):
+    """Generic extractor for the icon-leftbox structure"""
+    for label, text in index:
+        if keyword in label:
+            return text.replace(label, '').strip()
     return "N/A"
 
-def extract_education(soup):
+def extract_education(index):
     edu_data = {}
-    for box in soup.find_all('div', class_='icon-leftbox'):
-        strong = box.find('strong')
-        if strong:
-            label = strong.get_text()
-            if 'Education Category' in label:
-                edu_data['cat'] = box.get_text().replace('Education Category', '').strip()
-            elif 'Education Level' in label:
-                edu_data['lvl'] = box.get_text().replace('Education Level', '').strip()
+    for label, text in index:
+        if 'Education Category' in label:
+            edu_data['cat'] = text.replace('Education Category', '').strip()
+        elif 'Education Level' in label:
+            edu_data['lvl'] = text.replace('Education Level', '').strip()
     
     if edu_data:
         lvl = edu_data.get('lvl', '')
@@ -56,7 +86,7 @@ def extract_about(soup):
             if q and q.find('h4'): return q.find('h4').get_text().strip()
     return "N/A"
 
-def extract_additional_data(soup, url):
+def extract_additional_data(soup, index, url):
     data = {'profile_url': url}
     
     # Try to find the canonical profile URL in the page
@@ -90,68 +120,119 @@ def extract_additional_data(soup, url):
         'Smoking Habit': 'smoking_habit', 'Drinking Habit': 'drinking_habit'
     }
     
-    for box in soup.find_all('div', class_='icon-leftbox'):
-        strong = box.find('strong')
-        if strong:
-            label = strong.get_text()
-            val = box.get_text().replace(label, '').strip()
-            for key, field in mappings.items():
-                if key in label:
-                    data[field] = val
+    for label, text in index:
+        val = text.replace(label, '').strip()
+        for key, field in mappings.items():
+            if key in label:
+                data[field] = val
                     
     return data
 
 # --- Main Scraper Function ---
 def get_profile_data(url):
     try:
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'}
-        resp = requests.get(url, headers=headers)
+        # Serve from the on-disk cache while fresh, otherwise revalidate
+        entry = page_cache.load(url)
+        if page_cache.is_fresh(entry):
+            return page_cache.hit(entry)
+
+        with metrics.timer('fetch'):
+            resp = http_client.get(url, headers=page_cache.conditional_headers(entry))
+        if resp.status_code == 304 and entry:
+            return page_cache.revalidated(entry)
         resp.raise_for_status()
-        soup = BeautifulSoup(resp.content, 'html.parser')
-        
-        # 1. Profile Picture
-        profile_pic = None
-        # Try complex path first
-        try:
-            body = soup.find('body')
-            target_div = body.find_all('div', recursive=False)[2].find_all('div', recursive=False)[1].find_all('div', recursive=False)[0]
-            src = target_div.find('img').get('src', '')
-            if src and 'no_avatar' not in src: profile_pic = src
-        except:
-            pass
-        
-        # Fallback for picture
-        if not profile_pic:
-            for img in soup.find_all('img'):
-                src = img.get('src', '')
-                if 'uploads' in src and any(x in src.lower() for x in ['.jpg', '.jpeg', '.png']):
-                    profile_pic = src
-                    break
-        
-        text = soup.get_text()
-        
-        data = {
-            'profile_name': extract_name(soup, text),
-            'age': extract_field_from_iconbox(soup, 'Age').replace('Years', '').strip(), # Clean up 'Years' if present
-            'gender': extract_field_from_iconbox(soup, 'Gender'), # Or use text analysis fallback
-            'marital_status': extract_field_from_iconbox(soup, 'Marital Status'),
-            'mother_tongue': extract_field_from_iconbox(soup, 'Mother Tongue'),
-            'religion': extract_field_from_iconbox(soup, 'Religion'),
-            'caste': extract_field_from_iconbox(soup, 'Caste'),
-            'country': extract_field_from_iconbox(soup, 'Country'),
-            'education': extract_education(soup),
-            'occupation': extract_field_from_iconbox(soup, 'Occupation'),
-            'about': extract_about(soup),
-            'profile_picture': profile_pic,
-            'additional_data': extract_additional_data(soup, url)
-        }
-
-        # Validation
-        if data['profile_name'] == "N/A" and data['profile_picture'] is None:
-            return None # Failed to scrape meaningful data
-
-        return data
 
+        with metrics.timer('parse'):
+            profile = parse_profile(resp.content, url)
+        page_cache.save(url, profile, resp)
+        return profile
     except Exception as e:
         print(f"Scraper Exception for {url}: {e}")
-        return None
\ No newline at end of file
+        return None
+
+def _scrape(url):
+    page_cache.take_outcome()  # Forget whatever an earlier page on this thread left
+    with metrics.collect() as timings, http_client.deadline():
+        profile = get_profile_data(url)
+    return profile, timings, page_cache.take_outcome()
+
+def get_profiles_data(urls, max_workers=SCRAPE_THREADS, timings=None, cache_counts=None):
+    """Scrape many profiles concurrently over pooled keep-alive connections.
+
+    Yields (index, profile) pairs in completion order, where index is the
+    position of the URL in urls and profile is what get_profile_data returns.
+    Requests to a single host are capped by http_client.PER_HOST_LIMIT.
+
+    urls may be a lazy iterator; only a couple of pages per thread are read
+    ahead, so results start coming back before the input is exhausted. If a
+    timings dict is given, each index's stage timings are stored in it; if a
+    cache_counts dict is given, each page's page cache outcome ('hits',
+    'revalidated' or 'misses') is counted in it.
+    """
+    urls = enumerate(urls)
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='scrape') as pool:
+        futures = {}
+        for index, url in islice(urls, max_workers * 2):
+            futures[pool.submit(_scrape, url)] = index
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = futures.pop(future)
+                profile, row_timings, outcome = future.result()
+                if timings is not None:
+                    timings[index] = row_timings
+                if cache_counts is not None and outcome:
+                    cache_counts[outcome] = cache_counts.get(outcome, 0) + 1
+                yield index, profile
+            for index, url in islice(urls, len(done)):
+                futures[pool.submit(_scrape, url)] = index
+
+def make_soup(content):
+    if SKIP_HEAD:
+        return BeautifulSoup(content, PARSER, parse_only=NO_HEAD)
+    return BeautifulSoup(content, PARSER)
+
+def parse_profile(content, url):
+    soup = make_soup(content)
+    index = build_iconbox_index(soup)
+    
+    # 1. Profile Picture
+    profile_pic = None
+    # Try complex path first
+    try:
+        body = soup.find('body')
+        target_div = body.find_all('div', recursive=False)[2].find_all('div', recursive=False)[1].find_all('div', recursive=False)[0]
+        src = target_div.find('img').get('src', '')
+        if src and 'no_avatar' not in src: profile_pic = src
+    except:
+        pass
+    
+    # Fallback for picture
+    if not profile_pic:
+        for img in soup.find_all('img'):
+            src = img.get('src', '')
+            if 'uploads' in src and any(x in src.lower() for x in ['.jpg', '.jpeg', '.png']):
+                profile_pic = src
+                break
+    
+    data = {
+        'profile_name': extract_name(soup),
+        'age': extract_field_from_iconbox(index, 'Age').replace('Years', '').strip(), # Clean up 'Years' if present
+        'gender': extract_field_from_iconbox(index, 'Gender'), # Or use text analysis fallback
+        'marital_status': extract_field_from_iconbox(index, 'Marital Status'),
+        'mother_tongue': extract_field_from_iconbox(index, 'Mother Tongue'),
+        'religion': extract_field_from_iconbox(index, 'Religion'),
+        'caste': extract_field_from_iconbox(index, 'Caste'),
+        'country': extract_field_from_iconbox(index, 'Country'),
+        'education': extract_education(index),
+        'occupation': extract_field_from_iconbox(index, 'Occupation'),
+        'about': extract_about(soup),
+        'profile_picture': profile_pic,
+        'additional_data': extract_additional_data(soup, index, url)
+    }
+
+    # Validation
+    if data['profile_name'] == "N/A" and data['profile_picture'] is None:
+        return None # Failed to scrape meaningful data
+
+    return data
@@ -0,0 +1,97 @@
+import os
+import csv
+import math
+
+# openpyxl and pyarrow are imported on first use: they are slow to load and
+# only one of them is needed for any given upload (pyarrow is optional).
+
+# --- Configuration ---
+PARQUET_BATCH_ROWS = 1024
+
+def read_sheet(path):
+    """Open an uploaded sheet for streaming.
+
+    Returns (columns, total, rows): the header names, the number of data rows
+    if the format records it cheaply (None otherwise), and an iterator of
+    (index, record) pairs. Records are dicts keyed by column name with empty
+    cells as None; fully blank rows are skipped but still counted, so a row
+    keeps the same index however the file is read.
+    """
+    ext = os.path.splitext(path)[1].lower().lstrip('.')
+    if ext == 'csv':
+        raw, total = _csv_rows(path), None
+    elif ext == 'parquet':
+        raw, total = _parquet_rows(path)
+    else:
+        raw, total = _xlsx_rows(path)
+    header = next(raw, None) or []
+    columns = [str(name).strip() if name is not None else '' for name in header]
+    return columns, total, _records(columns, raw)
+
+def estimate_rows(path):
+    """Rough data-row count for a sheet whose total read_sheet can't give.
+
+    Counts newlines without parsing, so quoted line breaks and blank lines
+    make it an overestimate; good enough to tell a small job from a big one.
+    Only works for CSV: other formats are compressed, so returns None.
+    """
+    if os.path.splitext(path)[1].lower() != '.csv':
+        return None
+    lines = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            lines += chunk.count(b'\n')
+    return max(lines - 1, 0)
+
+def _records(columns, raw):
+    for index, values in enumerate(raw):
+        record = {name: clean_value(value) for name, value in zip(columns, values) if name}
+        if any(value is not None for value in record.values()):
+            yield index, record
+
+def clean_value(value):
+    """Normalise a cell: blanks and NaN become None, whole floats become ints."""
+    if value is None:
+        return None
+    if isinstance(value, float):
+        if math.isnan(value):
+            return None
+        if value.is_integer():
+            return int(value)
+    if isinstance(value, str):
+        value = value.strip()
+        return value or None
+    return value
+
+def _xlsx_rows(path):
+    from openpyxl import load_workbook
+    # read_only streams rows from the sheet XML instead of building every cell
+    wb = load_workbook(path, read_only=True, data_only=True)
+    ws = wb.worksheets[0]
+    total = ws.max_row - 1 if ws.max_row else None
+
+    def rows():
+        try:
+            yield from ws.iter_rows(values_only=True)
+        finally:
+            wb.close()
+    return rows(), total
+
+def _csv_rows(path):
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        yield from csv.reader(f)
+
+def _parquet_rows(path):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet uploads need pyarrow (pip install pyarrow)")
+    pf = pq.ParquetFile(path)
+
+    def rows():
+        names = pf.schema_arrow.names
+        yield names
+        for batch in pf.iter_batches(batch_size=PARQUET_BATCH_ROWS):
+            for record in batch.to_pylist():
+                yield [record[name] for name in names]
+    return rows(), pf.metadata.num_rows
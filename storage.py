@@ -0,0 +1,236 @@
+import os
+import json
+import time
+import shutil
+import sqlite3
+import threading
+
+import jobstore
+
+# --- Configuration ---
+UPLOAD_FOLDER = 'uploads'
+OUTPUT_FOLDER = 'outputs'
+# The same settings page_cache, media_cache and video_generator read; they
+# are not imported so that web processes stay free of the render stack.
+CACHE_DIRS = {
+    'pages': os.environ.get('PAGE_CACHE_DIR', os.path.join('cache', 'pages')),
+    'media': os.environ.get('MEDIA_CACHE_DIR', os.path.join('cache', 'media')),
+    'audio': os.environ.get('AUDIO_CACHE_DIR', os.path.join('cache', 'audio')),
+    'videos': os.environ.get('VIDEO_CACHE_DIR', os.path.join('cache', 'videos')),
+}
+TEMP_PREFIX = 'temp_video_'
+RETENTION_DAYS = float(os.environ.get('STORAGE_RETENTION_DAYS', '7'))  # 0 keeps jobs until the quota needs the space
+# Uploads, outputs, caches and temp dirs together; leaves room for renders in
+# progress and jobs.db on a 10 GB disk
+QUOTA_BYTES = int(os.environ.get('STORAGE_QUOTA_BYTES', str(7 * 1024 * 1024 * 1024)))
+TEMP_STALE_SECONDS = int(os.environ.get('TEMP_STALE_SECONDS', '3600'))  # Older temp dirs belong to a dead render
+SWEEP_INTERVAL = int(os.environ.get('STORAGE_SWEEP_INTERVAL', '600'))  # Seconds between maintenance passes
+CACHE_MIN_AGE = 900  # Cache files used this recently may still be read by a render
+REPORT_FILE = os.environ.get('STORAGE_REPORT_FILE', 'storage.json')
+
+# --- Sizes ---
+def dir_size(path, seen):
+    """Bytes used by the files under path whose inodes are not in seen yet.
+
+    Adds the inodes it counts to seen, so a file hard-linked from several
+    areas (a render cached in cache/videos) is counted once, under the
+    first area measured.
+    """
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                total += st.st_size
+    return total
+
+def temp_dirs(root='.'):
+    return [os.path.join(root, name) for name in os.listdir(root)
+            if name.startswith(TEMP_PREFIX) and os.path.isdir(os.path.join(root, name))]
+
+def disk_figures():
+    disk = shutil.disk_usage('.')
+    return {'total': disk.total, 'used': disk.used, 'free': disk.free}
+
+def usage():
+    """Bytes used by each area and in total (each file once), plus the filesystem totals."""
+    seen = set()
+    areas = {'uploads': dir_size(UPLOAD_FOLDER, seen), 'outputs': dir_size(OUTPUT_FOLDER, seen)}
+    for name, path in CACHE_DIRS.items():
+        areas[f'cache/{name}'] = dir_size(path, seen)
+    areas['temp'] = sum(dir_size(path, seen) for path in temp_dirs())
+    return {
+        'areas': areas,
+        'disk': disk_figures(),
+        'quota_bytes': QUOTA_BYTES,
+        'quota_used': sum(areas.values()),
+        'retention_days': RETENTION_DAYS,
+        'measured_at': time.time(),
+    }
+
+# --- Report ---
+# Walking every file is too slow for each /metrics scrape, so the usage
+# measured by the last maintenance pass is saved and served from here.
+
+def save_report(report):
+    tmp_path = f"{REPORT_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(report, f)
+    os.replace(tmp_path, REPORT_FILE)
+
+def report():
+    """Usage as of the last maintenance pass (measured now if there was none), with current disk figures."""
+    try:
+        with open(REPORT_FILE) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        saved = usage()
+        save_report(saved)
+    saved['disk'] = disk_figures()
+    return saved
+
+# --- Eviction ---
+def remove_file(path):
+    """Delete path. Returns the bytes released, which is 0 while another link to it remains."""
+    try:
+        st = os.lstat(path)
+        os.remove(path)
+    except OSError:
+        return 0
+    return st.st_size if st.st_nlink == 1 else 0
+
+def expire_job(db, job):
+    """Mark a finished job expired and delete its videos and upload. Returns bytes freed.
+
+    Returns None, deleting nothing, if the job was expired meanwhile or
+    requeued by /retry. The jobs row, its logs and its row records stay, so
+    the status page can still say what happened. An upload a promoted job
+    also reads is kept.
+    """
+    if not jobstore.mark_expired(db, job['id']):
+        return None
+    freed = 0
+    job_dir = os.path.join(OUTPUT_FOLDER, job['id'])
+    for root, _, files in os.walk(job_dir):
+        for name in files:
+            freed += remove_file(os.path.join(root, name))
+    shutil.rmtree(job_dir, ignore_errors=True)
+    if job['output_file'] and os.path.isfile(job['output_file']):
+        freed += remove_file(job['output_file'])  # ZIP built before downloads were streamed
+    if job['input_file'] and not jobstore.input_shared(db, job['id'], job['input_file']):
+        freed += remove_file(job['input_file'])
+    return freed
+
+def cache_files():
+    """(last used, path) for every cache file old enough to evict."""
+    cutoff = time.time() - CACHE_MIN_AGE
+    files = []
+    for path in CACHE_DIRS.values():
+        for root, _, names in os.walk(path):
+            for name in names:
+                if name.endswith(('.part', '.tmp', '.lock')):
+                    continue
+                file_path = os.path.join(root, name)
+                try:
+                    mtime = os.stat(file_path).st_mtime
+                except OSError:
+                    continue
+                if mtime < cutoff:
+                    files.append((mtime, file_path))
+    return files
+
+def enforce(db):
+    """Expire jobs past the retention period, then free space until under the quota.
+
+    The quota pass removes finished jobs and cache files alike, least
+    recently used first (downloads for jobs, reads for cache files). Jobs
+    that are pending or running are never touched. Returns (jobs expired,
+    cache files removed, bytes freed).
+    """
+    expired = removed = freed = 0
+    jobs = list(jobstore.expirable_jobs(db))
+    if RETENTION_DAYS > 0:
+        cutoff = time.time() - RETENTION_DAYS * 86400
+        while jobs and jobs[0]['last_used'] < cutoff:
+            released = expire_job(db, jobs.pop(0))
+            if released is not None:
+                freed += released
+                expired += 1
+
+    used = usage()['quota_used']
+    if used <= QUOTA_BYTES:
+        return expired, removed, freed
+    candidates = [(job['last_used'], job, None) for job in jobs]
+    candidates += [(mtime, None, path) for mtime, path in cache_files()]
+    candidates.sort(key=lambda candidate: candidate[0])
+    for _, job, path in candidates:
+        if used <= QUOTA_BYTES:
+            break
+        if job is not None:
+            released = expire_job(db, job)
+            if released is None:
+                continue
+            expired += 1
+        else:
+            released = remove_file(path)
+            removed += 1
+        used -= released
+        freed += released
+    if used > QUOTA_BYTES:
+        print(f"Storage over quota ({used} > {QUOTA_BYTES} bytes) with only active jobs and recent cache files left")
+    return expired, removed, freed
+
+def sweep_temp_dirs(root='.', max_age=TEMP_STALE_SECONDS):
+    """Remove render temp dirs left behind by killed ffmpeg runs. Returns how many.
+
+    Only dirs untouched for max_age seconds go, since other workers sharing
+    the directory may be rendering in theirs right now.
+    """
+    removed = 0
+    now = time.time()
+    for path in temp_dirs(root):
+        try:
+            if now - os.path.getmtime(path) < max_age:
+                continue
+        except OSError:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        removed += 1
+    return removed
+
+def maintain(interval=SWEEP_INTERVAL):
+    """One maintenance pass: sweep stale temp dirs, apply retention and quota, save the usage report.
+
+    Does nothing if another process (or thread) sharing jobs.db started a
+    pass less than interval seconds ago, so with several workers only one
+    of them evicts.
+    """
+    db = jobstore.connect()
+    try:
+        if not jobstore.claim_storage_pass(db, interval):
+            return
+        swept = sweep_temp_dirs()
+        expired, removed, freed = enforce(db)
+    finally:
+        db.close()
+    save_report(usage())
+    if swept or expired or removed:
+        print(f"Storage: removed {swept} stale temp dirs, expired {expired} jobs, "
+              f"evicted {removed} cache files ({freed // (1024 * 1024)} MB)")
+
+def start_maintenance(interval=SWEEP_INTERVAL):
+    """Run maintain() now and then every interval seconds in a daemon thread."""
+    def run():
+        while True:
+            try:
+                maintain(interval)
+            except (OSError, sqlite3.Error) as e:
+                print(f"Storage maintenance error: {e}")
+            time.sleep(interval)
+    thread = threading.Thread(target=run, daemon=True, name='storage-maintenance')
+    thread.start()
+    return thread
@@ -1,7 +1,10 @@
 import os
+import json
 import shutil
+import hashlib
 import subprocess
-import requests
+import media_cache
+import metrics
 from PIL import Image, ImageDraw, ImageFont, ImageOps
 import uuid
 
@@ -10,65 +13,168 @@ ASSET_DIR = "assets"
 TEMPLATE_BG = os.path.join(ASSET_DIR, "template-background.jpg")
 FONT_BOLD_FILE = os.path.join(ASSET_DIR, "font_bold.ttf")
 FONT_REGULAR_FILE = os.path.join(ASSET_DIR, "font_regular.ttf")
+DEFAULT_AUDIO = os.path.join(ASSET_DIR, "VN20251008_150305.mp3")
 
 # Settings for the SQUARE Floral Template
 SCENE_DURATION = 4
+FPS = 24
 VIDEO_WIDTH = 1024
 VIDEO_HEIGHT = 1024
 CX = VIDEO_WIDTH // 2
 
+# Soundtracks are pre-encoded to AAC once per distinct audio file
+AUDIO_CACHE_DIR = os.environ.get('AUDIO_CACHE_DIR', os.path.join('cache', 'audio'))
+AUDIO_CACHE_MAX_BYTES = int(os.environ.get('AUDIO_CACHE_MAX_BYTES', str(500 * 1024 * 1024)))
+AUDIO_BITRATE = '128k'
+
+# Finished videos are cached by what they show, so a profile that appears in
+# several uploads is rendered once. Bump TEMPLATE_VERSION whenever the layout,
+# template assets or encoding settings change, so stale renders aren't reused.
+TEMPLATE_VERSION = '2'
+RENDER_CACHE = os.environ.get('RENDER_CACHE', '1') == '1'
+VIDEO_CACHE_DIR = os.environ.get('VIDEO_CACHE_DIR', os.path.join('cache', 'videos'))
+VIDEO_CACHE_MAX_BYTES = int(os.environ.get('VIDEO_CACHE_MAX_BYTES', str(5 * 1024 * 1024 * 1024)))
+
+# Send rendered scenes to ffmpeg over a pipe instead of temporary PNG files
+PIPE_FRAMES = os.environ.get('FFMPEG_PIPE_FRAMES', '1') == '1'
+
+# Each scene crossfades into the next over the last FADE_DURATION seconds of
+# its slot. In segment mode only the fades are encoded frame by frame; each
+# still hold is a single frame shown until the next segment starts.
+FADE_DURATION = 0.5
+SEGMENT_ENCODE = os.environ.get('FFMPEG_SEGMENTS', '1') == '1'
+
+# Previews are the four scenes downscaled into one 2x2 JPEG contact sheet,
+# with no audio and no ffmpeg, for proofing a sheet before the full render.
+PREVIEW_SCALE = int(os.environ.get('PREVIEW_SCALE', '2'))  # Each scene at 1/PREVIEW_SCALE size
+PREVIEW_QUALITY = 80
+
+# Threads per x264 encode. 0 leaves it to ffmpeg (one per core); the worker
+# sets a share of the cores when several encodes run at once.
+FFMPEG_THREADS = int(os.environ.get('FFMPEG_THREADS', '0'))
+
 # Colors extracted from the template (Dark Brown / Muted Pink)
 TEXT_COLOR_DARK = "#5D4037"
 TEXT_COLOR_LIGHT = "#7A5549"
 
-def create_scene_image(profile, scene_number, temp_dir):
-    img = Image.open(TEMPLATE_BG).convert("RGBA")
-    draw = ImageDraw.Draw(img)
+# --- Layout Coordinates (Tuned for 1024x1024) ---
+# We place the photo higher so it "sits" on the top edge of the box
+PFP_Y = 160
+PFP_SIZE = 300
 
-    # Fonts
-    try:
+# Name appears just below the photo with more spacing
+Y_NAME = PFP_Y + PFP_SIZE + 50  # y = 510
+
+# URL appears below the name
+Y_URL = Y_NAME + 60             # y = 570
+
+# Data grid starts below the URL
+Y_COL_START = Y_URL + 60        # y = 630
+Y_ROW2 = Y_COL_START + 100
+
+# Column Positions (Centered in the layout)
+COL1 = 300
+COL2 = 724
+
+# Headings that never change between profiles: (scene, position, text)
+STATIC_LABELS = [
+    (1, (COL1, Y_COL_START), "AGE"),
+    (1, (COL2, Y_COL_START), "RELIGION"),
+    (1, (COL1, Y_ROW2), "MARITAL STATUS"),
+    (1, (COL2, Y_ROW2), "MOTHER TONGUE"),
+    (2, (CX, Y_COL_START), "EDUCATION"),
+    (2, (CX, Y_ROW2), "OCCUPATION"),
+    (3, (CX, Y_COL_START), "Lifestyle"),
+    (4, (CX, Y_COL_START), "About me"),
+]
+
+class RenderContext:
+    """Fonts and per-scene base layers, loaded once per process.
+
+    Each base layer is the template background with that scene's static
+    labels already drawn, so a profile only adds its own text and photo to a
+    copy of it.
+    """
+    def __init__(self):
         # Slightly smaller fonts to fit the square layout better
-        font_h1 = ImageFont.truetype(FONT_BOLD_FILE, 55)  # Name
-        font_h2 = ImageFont.truetype(FONT_BOLD_FILE, 35)  # Labels (Age, Religion...)
-        font_p = ImageFont.truetype(FONT_REGULAR_FILE, 30) # Values
-        font_link = ImageFont.truetype(FONT_REGULAR_FILE, 22) # URL
-    except IOError:
-        print("Error: Fonts not found.")
-        return None
+        self.font_h1 = ImageFont.truetype(FONT_BOLD_FILE, 55)  # Name
+        self.font_h2 = ImageFont.truetype(FONT_BOLD_FILE, 35)  # Labels (Age, Religion...)
+        self.font_p = ImageFont.truetype(FONT_REGULAR_FILE, 30) # Values
+        self.font_link = ImageFont.truetype(FONT_REGULAR_FILE, 22) # URL
 
-    # --- 1. Profile Picture Logic ---
-    # We place this higher so it "sits" on the top edge of the box
-    pfp_y = 160 
-    pfp_size = 300
-    
+        background = Image.open(TEMPLATE_BG).convert("RGBA")
+        self.base_layers = {}
+        for scene_number in range(1, 5):
+            layer = background.copy()
+            draw = ImageDraw.Draw(layer)
+            for scene, xy, text in STATIC_LABELS:
+                if scene == scene_number:
+                    draw.text(xy, text, font=self.font_h2, fill=TEXT_COLOR_DARK, anchor="ms")
+            self.base_layers[scene_number] = layer
+
+        self.avatar_mask = Image.new("L", (PFP_SIZE, PFP_SIZE), 0)
+        ImageDraw.Draw(self.avatar_mask).ellipse((0, 0, PFP_SIZE, PFP_SIZE), fill=255)
+
+_render_context = None
+
+def get_render_context():
+    global _render_context
+    if _render_context is None:
+        try:
+            _render_context = RenderContext()
+        except IOError:
+            print("Error: Fonts not found.")
+            return None
+    return _render_context
+
+def build_avatar(pic_path):
+    """Decode a profile photo and cut the circular PFP_SIZE avatar from it."""
+    ctx = get_render_context()
+    pfp = Image.open(pic_path)
+    # For JPEGs, let the decoder downscale by 1/2..1/8 while still giving us
+    # at least PFP_SIZE pixels per side; a no-op for other formats.
+    pfp.draft("RGB", (PFP_SIZE, PFP_SIZE))
+    pfp = pfp.convert("RGBA")
+    avatar = ImageOps.fit(pfp, ctx.avatar_mask.size, centering=(0.5, 0.5))
+    avatar.putalpha(ctx.avatar_mask)
+    return avatar
+
+def load_avatar(pic_path):
+    """The avatar for a picture download_media fetched, or None when there is none.
+
+    Never fetches: the picture is downloaded once per row, under the row's
+    deadline, before rendering starts.
+    """
     try:
-        pic_path = os.path.join(temp_dir, "profile_pic.jpg")
-        
-        # Download if not exists
-        if not os.path.exists(pic_path) and profile.get("profile_picture"):
-             with open(pic_path, "wb") as f:
-                f.write(requests.get(profile["profile_picture"]).content)
-
-        if os.path.exists(pic_path):
-            pfp = Image.open(pic_path).convert("RGBA")
-            mask = Image.new("L", (pfp_size, pfp_size), 0)
-            ImageDraw.Draw(mask).ellipse((0, 0, pfp_size, pfp_size), fill=255)
-            pfp_circular = ImageOps.fit(pfp, mask.size, centering=(0.5, 0.5))
-            pfp_circular.putalpha(mask)
-            img.paste(pfp_circular, (CX - (pfp_size // 2), pfp_y), pfp_circular)
+        if pic_path:
+            return build_avatar(pic_path)
     except Exception as e:
         print(f"PFP Error: {e}")
+    return None
 
-    # --- 2. Layout Coordinates (Tuned for 1024x1024) ---
-    
-    # Name appears just below the photo with more spacing
-    y_name = pfp_y + pfp_size + 50  # y = 510
-    
-    # URL appears below the name
-    y_url = y_name + 60             # y = 540
-    
-    # Data grid starts below the URL
-    y_col_start = y_url + 60        # y = 600
+def create_scene_image(profile, scene_number, temp_dir, avatar=None):
+    img = render_scene(profile, scene_number, avatar)
+    if img is None:
+        return None
+    outfile = os.path.join(temp_dir, f"scene-{scene_number}.png")
+    img.save(outfile)
+    return outfile
+
+def render_scene(profile, scene_number, avatar=None):
+    """Draw one scene for a profile and return it as an RGBA image."""
+    ctx = get_render_context()
+    if ctx is None:
+        return None
+    img = ctx.base_layers[scene_number].copy()
+    draw = ImageDraw.Draw(img)
+    font_h1, font_p, font_link = ctx.font_h1, ctx.font_p, ctx.font_link
+
+    # --- 1. Profile Picture Logic ---
+    # Built once per row by the caller (load_avatar); None means no picture
+    if avatar is not None:
+        img.paste(avatar, (CX - (PFP_SIZE // 2), PFP_Y), avatar)
+
+    # --- 2. Text ---
 
     # Data Extraction
     url_text = profile.get("additional_data", {}).get("profile_url", "")
@@ -77,120 +183,369 @@ def create_scene_image(profile, scene_number, temp_dir):
     
     # Draw Name & URL (Common to all scenes)
     display_name = name if scene_number == 1 else name_alt
-    draw.text((CX, y_name), display_name, font=font_h1, fill=TEXT_COLOR_DARK, anchor="ms")
-    draw.text((CX, y_url), url_text, font=font_link, fill=TEXT_COLOR_LIGHT, anchor="ms")
-
-    # Column Positions (Centered in the layout)
-    col1 = 300
-    col2 = 724
+    draw.text((CX, Y_NAME), display_name, font=font_h1, fill=TEXT_COLOR_DARK, anchor="ms")
+    draw.text((CX, Y_URL), url_text, font=font_link, fill=TEXT_COLOR_LIGHT, anchor="ms")
     
-    # --- Scene Specific Content ---
+    # --- Scene Specific Content (labels come from the base layer) ---
     
     if scene_number == 1:
         # Row 1
-        draw.text((col1, y_col_start), "AGE", font=font_h2, fill=TEXT_COLOR_DARK, anchor="ms")
-        draw.text((col1, y_col_start + 40), f"{profile.get('age', 'N/A')} Years", font=font_p, fill=TEXT_COLOR_LIGHT, anchor="ms")
-        
-        draw.text((col2, y_col_start), "RELIGION", font=font_h2, fill=TEXT_COLOR_DARK, anchor="ms")
-        draw.text((col2, y_col_start + 40), profile.get("religion", "N/A"), font=font_p, fill=TEXT_COLOR_LIGHT, anchor="ms")
+        draw.text((COL1, Y_COL_START + 40), f"{profile.get('age', 'N/A')} Years", font=font_p, fill=TEXT_COLOR_LIGHT, anchor="ms")
+        draw.text((COL2, Y_COL_START + 40), profile.get("religion", "N/A"), font=font_p, fill=TEXT_COLOR_LIGHT, anchor="ms")
         
         # Row 2
-        y_row2 = y_col_start + 100
-        draw.text((col1, y_row2), "MARITAL STATUS", font=font_h2, fill=TEXT_COLOR_DARK, anchor="ms")
-        draw.text((col1, y_row2 + 40), profile.get("marital_status", "N/A"), font=font_p, fill=TEXT_COLOR_LIGHT, anchor="ms")
-        
-        draw.text((col2, y_row2), "MOTHER TONGUE", font=font_h2, fill=TEXT_COLOR_DARK, anchor="ms")
-        draw.text((col2, y_row2 + 40), profile.get("mother_tongue", "N/A"), font=font_p, fill=TEXT_COLOR_LIGHT, anchor="ms")
+        draw.text((COL1, Y_ROW2 + 40), profile.get("marital_status", "N/A"), font=font_p, fill=TEXT_COLOR_LIGHT, anchor="ms")
+        draw.text((COL2, Y_ROW2 + 40), profile.get("mother_tongue", "N/A"), font=font_p, fill=TEXT_COLOR_LIGHT, anchor="ms")
 
     elif scene_number == 2:
-        draw.text((CX, y_col_start), "EDUCATION", font=font_h2, fill=TEXT_COLOR_DARK, anchor="ms")
-        draw.text((CX, y_col_start + 40), profile.get("education", "N/A"), font=font_p, fill=TEXT_COLOR_LIGHT, anchor="ms")
-        
-        y_row2 = y_col_start + 100
-        draw.text((CX, y_row2), "OCCUPATION", font=font_h2, fill=TEXT_COLOR_DARK, anchor="ms")
-        draw.text((CX, y_row2 + 40), profile.get("occupation", "N/A"), font=font_p, fill=TEXT_COLOR_LIGHT, anchor="ms")
+        draw.text((CX, Y_COL_START + 40), profile.get("education", "N/A"), font=font_p, fill=TEXT_COLOR_LIGHT, anchor="ms")
+        draw.text((CX, Y_ROW2 + 40), profile.get("occupation", "N/A"), font=font_p, fill=TEXT_COLOR_LIGHT, anchor="ms")
 
     elif scene_number == 3:
-        draw.text((CX, y_col_start), "Lifestyle", font=font_h2, fill=TEXT_COLOR_DARK, anchor="ms")
-        y = y_col_start + 50
+        y = Y_COL_START + 50
         draw.text((CX, y), profile.get("additional_data", {}).get("food_habit", ""), font=font_p, fill=TEXT_COLOR_LIGHT, anchor="ms")
         draw.text((CX, y + 40), profile.get("additional_data", {}).get("smoking_habit", ""), font=font_p, fill=TEXT_COLOR_LIGHT, anchor="ms")
         draw.text((CX, y + 80), profile.get("additional_data", {}).get("drinking_habit", ""), font=font_p, fill=TEXT_COLOR_LIGHT, anchor="ms")
 
     elif scene_number == 4:
-        draw.text((CX, y_col_start), "About me", font=font_h2, fill=TEXT_COLOR_DARK, anchor="ms")
         about = profile.get("about", "")
         # Wider text wrap for square layout
         lines = [about[i:i+50] for i in range(0, len(about), 50)]
-        y = y_col_start + 50
+        y = Y_COL_START + 50
         for line in lines:
             draw.text((CX, y), line, font=font_p, fill=TEXT_COLOR_LIGHT, anchor="ms")
             y += 40
         draw.text((CX, y + 20), profile.get("country", ""), font=font_p, fill=TEXT_COLOR_LIGHT, anchor="ms")
 
-    outfile = os.path.join(temp_dir, f"scene-{scene_number}.png")
-    img.save(outfile)
-    return outfile
+    return img
+
+def download_media(profile_json):
+    """Resolve the background music and profile picture to local files.
+
+    Both come from the shared media cache, so an asset used by many rows or
+    jobs is downloaded once. Network-bound, so the worker runs this in a
+    thread pool ahead of the CPU-bound rendering. Failures are non-fatal: a
+    missing track falls back to the default audio and a missing picture is
+    simply not drawn.
+    """
+    with metrics.timer('media'):
+        music_file = media_cache.fetch(profile_json.get("background_music_url"))
+        if profile_json.get("background_music_url") and not music_file:
+            print("Failed to download music, using default track.")
+        if not music_file and os.path.exists(DEFAULT_AUDIO):
+            music_file = DEFAULT_AUDIO
+        return {
+            "music": music_file,
+            "picture": media_cache.fetch(profile_json.get("profile_picture")),
+        }
 
-def generate_video_from_profile(profile_json, output_filename):
+def new_temp_dir():
     temp_dir = f"temp_video_{uuid.uuid4()}"
     os.makedirs(temp_dir, exist_ok=True)
+    return temp_dir
+
+def prepare_audio_track(music_file):
+    """Return an AAC file of music_file looped/trimmed to the video length.
+
+    Encoded once per distinct audio content and cached, so each video can
+    mux it with -c:a copy. Returns None if the encode fails.
+    """
+    total = SCENE_DURATION * 4
+    try:
+        key = hashlib.sha256(f"{media_cache.content_hash(music_file)}:{total}:{AUDIO_BITRATE}".encode()).hexdigest()
+        track = os.path.join(AUDIO_CACHE_DIR, f"{key}.m4a")
+        if os.path.exists(track):
+            os.utime(track)  # Keep it from LRU eviction
+            return track
+
+        os.makedirs(AUDIO_CACHE_DIR, exist_ok=True)
+        tmp_track = os.path.join(AUDIO_CACHE_DIR, f"{key}.{os.getpid()}.tmp")
+        subprocess.run([
+            'ffmpeg', '-v', 'error', '-stream_loop', '-1', '-i', music_file,
+            '-t', str(total), '-vn', '-c:a', 'aac', '-b:a', AUDIO_BITRATE,
+            '-f', 'mp4', '-y', tmp_track
+        ], check=True)
+        os.replace(tmp_track, track)
+        media_cache.evict_lru(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES)
+        return track
+    except Exception as e:
+        print(f"Audio pre-encode failed, encoding inline: {e}")
+        return None
+
+def audio_args(music_file):
+    """ffmpeg (input, codec) arguments for the soundtrack."""
+    track = prepare_audio_track(music_file)
+    if track:
+        return ['-i', track], ['-c:a', 'copy']
+    # Loop at the demuxer instead of buffering the whole track with aloop
+    return ['-stream_loop', '-1', '-i', music_file], ['-c:a', 'aac', '-b:a', AUDIO_BITRATE]
+
+def scene_lengths():
+    """Seconds each xfade input must last.
+
+    Every xfade overlaps its inputs by FADE_DURATION, so the later scenes are
+    that much longer; this puts the fades at the end of each SCENE_DURATION
+    slot and makes the video exactly four slots long.
+    """
+    return [SCENE_DURATION] + [SCENE_DURATION + FADE_DURATION] * 3
+
+def xfade_graph(video_inputs):
+    """Filter graph that crossfades the four scenes."""
+    offset1 = SCENE_DURATION - FADE_DURATION
+    offset2 = (SCENE_DURATION * 2) - FADE_DURATION
+    offset3 = (SCENE_DURATION * 3) - FADE_DURATION
+    v0, v1, v2, v3 = video_inputs
+    return (
+        f"[{v0}][{v1}]xfade=transition=fade:duration={FADE_DURATION}:offset={offset1}[v1];"
+        f"[v1][{v2}]xfade=transition=fade:duration={FADE_DURATION}:offset={offset2}[v2];"
+        f"[v2][{v3}]xfade=transition=fade:duration={FADE_DURATION}:offset={offset3}[v3]"
+    )
+
+def set_ffmpeg_threads(threads):
+    global FFMPEG_THREADS
+    FFMPEG_THREADS = threads
+
+def thread_args():
+    return ['-threads', str(FFMPEG_THREADS)] if FFMPEG_THREADS else []
+
+def output_args(audio_input, audio_codec, output_filename):
+    total = SCENE_DURATION * 4
+    return [
+        '-map', '[v3]', '-map', f"{audio_input}:a",
+        '-c:v', 'libx264', '-pix_fmt', 'yuv420p',
+    ] + thread_args() + audio_codec + [
+        '-r', str(FPS), '-t', str(total), '-y', output_filename
+    ]
+
+def encode_from_frames(frames, music_file, output_filename):
+    """Stitch the scenes by piping raw RGB frames into ffmpeg's stdin.
+
+    Each scene is sent once as a single rawvideo frame; the filter graph
+    picks it out and holds it for SCENE_DURATION seconds.
+    """
+    graph = "[0:v]split=4[f0][f1][f2][f3];" + "".join(
+        f"[f{i}]trim=start_frame={i}:end_frame={i + 1},setpts=PTS-STARTPTS,"
+        f"loop=loop={round(length * FPS) - 1}:size=1:start=0,setpts=N/{FPS}/TB,fps={FPS}[s{i}];"
+        for i, length in enumerate(scene_lengths())
+    ) + xfade_graph(["s0", "s1", "s2", "s3"])
+    audio_input, audio_codec = audio_args(music_file)
+    cmd = ['ffmpeg'] + raw_input_args(frames) + audio_input + [
+        '-filter_complex', graph,
+    ] + output_args(1, audio_codec, output_filename)
+    pipe_frames(cmd, frames)
+
+def raw_input_args(frames):
+    width, height = frames[0].size
+    return [
+        '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f"{width}x{height}",
+        '-framerate', str(FPS), '-i', 'pipe:0',
+    ]
+
+def pipe_frames(cmd, frames):
+    """Run ffmpeg with each frame written to its stdin as raw RGB."""
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    try:
+        for frame in frames:
+            proc.stdin.write(frame.convert("RGB").tobytes())
+        proc.stdin.close()
+    except BrokenPipeError:
+        pass  # ffmpeg exited early; its return code says why
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+def encode_segments(frames, music_file, output_filename):
+    """Encode only what moves, in a single ffmpeg run straight to the output.
+
+    Each scene becomes a two-frame hold (its still, repeated at the end of
+    its slot) and each crossfade a FADE_DURATION clip. Every piece is given
+    its place on the usual timeline with setpts and interleave merges them
+    in order, so one x264 stream holds about 40 frames instead of
+    SCENE_DURATION * 4 * FPS, with a single keyframe and no intermediate
+    files. The result is variable frame rate; set FFMPEG_SEGMENTS=0 for a
+    constant 24 fps stream.
+    """
+    fade_frames = round(FADE_DURATION * FPS)
+    holds = [SCENE_DURATION - FADE_DURATION] * 3 + [SCENE_DURATION]
+    graph = "[0:v]split=4[f0][f1][f2][f3];"
+    for i, hold in enumerate(holds):
+        start = i * SCENE_DURATION
+        graph += (
+            f"[f{i}]trim=start_frame={i}:end_frame={i + 1},setpts=PTS-STARTPTS,split=3[still{i}][out{i}][in{i}];"
+            f"[still{i}]loop=loop=1:size=1:start=0,setpts=({start}+N*{hold - 1 / FPS})/TB[hold{i}];"
+        )
+    for i in range(3):
+        start = i * SCENE_DURATION + holds[i]
+        graph += (
+            f"[out{i}]loop=loop={fade_frames - 1}:size=1:start=0,setpts=N/{FPS}/TB,fps={FPS}[a{i}];"
+            f"[in{i + 1}]loop=loop={fade_frames - 1}:size=1:start=0,setpts=N/{FPS}/TB,fps={FPS}[b{i}];"
+            f"[a{i}][b{i}]xfade=transition=fade:duration={FADE_DURATION}:offset=0,trim=end_frame={fade_frames},"
+            f"setpts=({start}+N/{FPS})/TB[fade{i}];"
+        )
+    graph += "[in0]nullsink;[out3]nullsink;"
+    graph += "[hold0][fade0][hold1][fade1][hold2][fade2][hold3]interleave=nb_inputs=7[v]"
+
+    audio_input, audio_codec = audio_args(music_file)
+    cmd = ['ffmpeg', '-v', 'error'] + raw_input_args(frames) + audio_input + [
+        '-filter_complex', graph, '-map', '[v]', '-map', '1:a',
+        '-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-fps_mode', 'passthrough',
+    ] + thread_args() + audio_codec + ['-t', str(SCENE_DURATION * 4), '-y', output_filename]
+    pipe_frames(cmd, frames)
+
+def encode_from_files(scene_files, music_file, output_filename):
+    """Stitch the scenes from PNG files on disk (fallback path)."""
+    cmd = ['ffmpeg']
+    for scene_file, length in zip(scene_files, scene_lengths()):
+        cmd += ['-loop', '1', '-t', str(length), '-i', scene_file]
+    audio_input, audio_codec = audio_args(music_file)
+    cmd += audio_input + ['-filter_complex', xfade_graph(["0:v", "1:v", "2:v", "3:v"])]
+    subprocess.run(cmd + output_args(4, audio_codec, output_filename), check=True)
+
+# --- Render Cache ---
+def render_key(profile_json, media):
+    """Deterministic key for the video a profile renders to.
+
+    The picture and music URLs are replaced by the content hashes of what
+    they downloaded, so the same assets behind different URLs share a key.
+    """
+    profile = {k: v for k, v in profile_json.items() if k not in ('profile_picture', 'background_music_url')}
+    picture = media.get("picture")
+    identity = {
+        'template': TEMPLATE_VERSION,
+        'settings': [SCENE_DURATION, FPS, VIDEO_WIDTH, VIDEO_HEIGHT, AUDIO_BITRATE],
+        'profile': profile,
+        'picture': media_cache.content_hash(picture) if picture else None,
+        'music': media_cache.content_hash(media["music"]),
+    }
+    return hashlib.sha256(json.dumps(identity, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def link_or_copy(src, dst):
+    """Hard-link src to dst (same filesystem), falling back to a copy."""
+    tmp = f"{dst}.{os.getpid()}.tmp"
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+def reuse_render(key, output_filename):
+    """Put a cached render for key at output_filename. Returns False on a miss."""
+    cached = os.path.join(VIDEO_CACHE_DIR, f"{key}.mp4")
+    try:
+        link_or_copy(cached, output_filename)
+        os.utime(cached)  # Keep it from LRU eviction
+        return True
+    except OSError:
+        return False
+
+def store_render(key, output_filename):
+    try:
+        os.makedirs(VIDEO_CACHE_DIR, exist_ok=True)
+        link_or_copy(output_filename, os.path.join(VIDEO_CACHE_DIR, f"{key}.mp4"))
+        media_cache.evict_lru(VIDEO_CACHE_DIR, VIDEO_CACHE_MAX_BYTES)
+    except OSError as e:
+        print(f"Could not cache render: {e}")
+
+def generate_video_from_profile(profile_json, output_filename, media=None):
+    """Render the four scenes for a profile and stitch them into output_filename.
+
+    media is what download_media returned, if the caller already fetched it.
+    """
+    if media is None:
+        media = download_media(profile_json)
     
     # Audio Handling
-    music_file = os.path.join(temp_dir, "music.mp3")
-    has_music = False
-    
-    if profile_json.get("background_music_url"):
+    music_file = media["music"]
+    if not music_file:
+        return None # No audio available
+
+    key = None
+    if RENDER_CACHE:
+        try:
+            key = render_key(profile_json, media)
+            if reuse_render(key, output_filename):
+                return output_filename
+        except Exception as e:
+            print(f"Render cache lookup failed: {e}")
+
+    if encode_video(profile_json, media, output_filename):
+        if key:
+            store_render(key, output_filename)
+        return output_filename
+    return None
+
+def encode_video(profile_json, media, output_filename):
+    """Render the scenes and encode them with ffmpeg. Returns output_filename, or None on failure."""
+    music_file = media["music"]
+    try:
+        with metrics.timer('render'):
+            frames = render_frames(profile_json, media)
+    except Exception as e:
+        print(f"Video Gen Error: {e}")
+        return None
+
+    with metrics.timer('encode'):
+        return stitch_frames(frames, music_file, output_filename)
+
+def render_frames(profile_json, media):
+    """Draw the four scenes. Raises if one of them can't be drawn."""
+    frames = []
+    avatar = load_avatar(media["picture"]) if get_render_context() else None
+    for i in range(1, 5):
+        frame = render_scene(profile_json, i, avatar)
+        if frame is None: raise Exception(f"Failed to create scene {i}")
+        frames.append(frame)
+    return frames
+
+def generate_preview(profile_json, output_filename, media=None):
+    """Render the four scenes into a contact sheet at output_filename (JPEG).
+
+    Same drawing code as the video, so the preview shows exactly what the
+    full render will. Returns output_filename, or None on failure.
+    """
+    if media is None:
+        media = download_media(profile_json)
+    try:
+        with metrics.timer('render'):
+            frames = render_frames(profile_json, media)
+            tile_w, tile_h = VIDEO_WIDTH // PREVIEW_SCALE, VIDEO_HEIGHT // PREVIEW_SCALE
+            sheet = Image.new("RGB", (tile_w * 2, tile_h * 2), "white")
+            for i, frame in enumerate(frames):
+                sheet.paste(frame.convert("RGB").reduce(PREVIEW_SCALE), ((i % 2) * tile_w, (i // 2) * tile_h))
+            sheet.save(output_filename, "JPEG", quality=PREVIEW_QUALITY)
+        return output_filename
+    except Exception as e:
+        print(f"Preview Error: {e}")
+        return None
+
+def stitch_frames(frames, music_file, output_filename):
+    """Encode rendered frames to output_filename, over a pipe or via PNG files."""
+    # Video Stitching
+    if SEGMENT_ENCODE:
         try:
-            with open(music_file, "wb") as f:
-                f.write(requests.get(profile_json["background_music_url"]).content)
-            has_music = True
-        except:
-            print("Failed to download music, using silence.")
-
-    if not has_music:
-        # Use existing audio from assets
-        default_audio = os.path.join(ASSET_DIR, "VN20251008_150305.mp3")
-        if os.path.exists(default_audio):
-            shutil.copy(default_audio, music_file)
-            has_music = True
-        else:
-            return None # No audio available
+            encode_segments(frames, music_file, output_filename)
+            return output_filename
+        except Exception as e:
+            print(f"Segment encode failed, falling back to a full encode: {e}")
 
+    if PIPE_FRAMES:
+        try:
+            encode_from_frames(frames, music_file, output_filename)
+            return output_filename
+        except Exception as e:
+            print(f"Frame pipe failed, falling back to PNG files: {e}")
+
+    temp_dir = new_temp_dir()
     try:
         scenes = []
-        for i in range(1, 5):
-            s = create_scene_image(profile_json, i, temp_dir)
-            if not s: raise Exception(f"Failed to create scene {i}")
-            scenes.append(s)
-
-        # Video Stitching
-        offset1 = SCENE_DURATION - 0.5
-        offset2 = (SCENE_DURATION * 2) - 0.5
-        offset3 = (SCENE_DURATION * 3) - 0.5
-        total = SCENE_DURATION * 4
-
-        cmd = [
-            'ffmpeg',
-            '-loop', '1', '-t', str(SCENE_DURATION), '-i', scenes[0],
-            '-loop', '1', '-t', str(SCENE_DURATION), '-i', scenes[1],
-            '-loop', '1', '-t', str(SCENE_DURATION), '-i', scenes[2],
-            '-loop', '1', '-t', str(SCENE_DURATION), '-i', scenes[3],
-            '-i', music_file,
-            '-filter_complex',
-            f"[0:v][1:v]xfade=transition=fade:duration=0.5:offset={offset1}[v1];"
-            f"[v1][2:v]xfade=transition=fade:duration=0.5:offset={offset2}[v2];"
-            f"[v2][3:v]xfade=transition=fade:duration=0.5:offset={offset3}[v3];"
-            f"[4:a]aloop=loop=-1:size=2e+09[a]",
-            '-map', '[v3]', '-map', '[a]',
-            '-c:v', 'libx264', '-c:a', 'aac', '-pix_fmt', 'yuv420p',
-            '-r', '24', '-t', str(total), '-y', output_filename
-        ]
-        
-        subprocess.run(cmd, check=True)
+        for i, frame in enumerate(frames, start=1):
+            scene_file = os.path.join(temp_dir, f"scene-{i}.png")
+            frame.save(scene_file)
+            scenes.append(scene_file)
+        encode_from_files(scenes, music_file, output_filename)
+        return output_filename
 
     except Exception as e:
         print(f"Video Gen Error: {e}")
     finally:
         if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
\ No newline at end of file
+            shutil.rmtree(temp_dir)
@@ -1,135 +1,485 @@
 import os
-import sqlite3
-import pandas as pd
+import socket
+import argparse
 import time
-import shutil
-import zipfile
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 # Import our custom modules
-from scraper import get_profile_data
-from video_generator import generate_video_from_profile
+import http_client
+import jobstore
+import metrics
+import storage
+from scraper import get_profiles_data
+from sheet_reader import read_sheet, estimate_rows
+from video_generator import generate_video_from_profile, generate_preview, download_media, set_ffmpeg_threads, FFMPEG_THREADS
 
 # Configuration
-DATABASE = 'jobs.db'
+DATABASE = jobstore.DATABASE
 UPLOAD_FOLDER = 'uploads'
 OUTPUT_FOLDER = 'outputs'
 
 def get_db():
-    db = sqlite3.connect(DATABASE)
-    db.row_factory = sqlite3.Row
-    return db
+    return jobstore.connect()
 
 def update_job_log(job_id, message):
-    try:
-        import datetime
-        timestamp = datetime.datetime.now().strftime("%H:%M:%S")
-        db = get_db()
-        current_logs = db.execute('SELECT logs FROM jobs WHERE id = ?', (job_id,)).fetchone()
-        new_logs = (current_logs['logs'] if current_logs else '') + f"[{timestamp}] {message}\n"
-        db.execute('UPDATE jobs SET logs = ? WHERE id = ?', (new_logs, job_id))
-        db.commit()
-        db.close()
-    except Exception as e:
-        print(f"Log update error: {e}")
+    jobstore.append_job_log(job_id, message)
+
+# --- Parallel Execution ---
+# Rows are fetched (scrape + media download) in thread pools and rendered
+# (PIL scenes + ffmpeg) in a process pool. WORKER_CONCURRENCY=1 keeps the
+# original one-row-at-a-time behaviour.
+WORKER_CONCURRENCY = int(os.environ.get('WORKER_CONCURRENCY', '1'))
+FETCH_THREADS = int(os.environ.get('FETCH_THREADS', str(max(4, WORKER_CONCURRENCY * 2))))
+
+# --- Scheduling ---
+# A worker runs up to MAX_ACTIVE_JOBS jobs at once, all sharing its fetch and
+# render pools. Render slots are handed out row by row: the job with the
+# fewest rows left goes first, and a job already rendering JOB_RENDER_QUOTA
+# rows only gets another slot when no other job has a row waiting. A 5-row
+# sheet uploaded behind a 3,000-row one starts at the next free slot.
+MAX_ACTIVE_JOBS = int(os.environ.get('WORKER_ACTIVE_JOBS', '4'))
+JOB_RENDER_QUOTA = int(os.environ.get('JOB_RENDER_QUOTA', str(max(1, WORKER_CONCURRENCY // 2))))
+ROW_READ_AHEAD = max(2, WORKER_CONCURRENCY * 2)  # Rows a job may have fetched but not yet rendered
+
+def ffmpeg_thread_budget(render_slots, processes=1):
+    """x264 threads per encode, so that concurrent encodes share the cores rather than oversubscribe them."""
+    if FFMPEG_THREADS:
+        return FFMPEG_THREADS
+    return max(1, (os.cpu_count() or 1) // (render_slots * processes))
+
+class InlineExecutor(Executor):
+    """Runs each task immediately in the calling thread (sequential mode)."""
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+def make_fetch_pool(workers):
+    if workers <= 1:
+        return InlineExecutor()
+    return ThreadPoolExecutor(max_workers=FETCH_THREADS, thread_name_prefix='fetch')
+
+def make_render_pool(workers, ffmpeg_threads):
+    if workers <= 1:
+        set_ffmpeg_threads(ffmpeg_threads)
+        return InlineExecutor()
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=set_ffmpeg_threads, initargs=(ffmpeg_threads,))
+
+def fetch_media(profile_data):
+    """Thread-pool stage: make sure the row's music and picture are cached locally.
+
+    Returns (profile, media, stage timings).
+    """
+    if not profile_data:
+        return None, None, []
+    with metrics.collect() as timings, http_client.deadline():
+        media = download_media(profile_data)
+    return profile_data, media, timings
+
+def render_row(profile_data, output_filename, media):
+    """Process-pool stage: render the scenes and run ffmpeg for one row.
+
+    Returns (success, stage timings); the timings are recorded in the render
+    process and travel back with the result.
+    """
+    with metrics.collect() as timings:
+        generate_video_from_profile(profile_data, output_filename, media)
+    return os.path.exists(output_filename), timings
+
+def render_preview_row(profile_data, output_filename, media):
+    """Process-pool stage for preview jobs: a contact sheet instead of a video."""
+    with metrics.collect() as timings:
+        generate_preview(profile_data, output_filename, media)
+    return os.path.exists(output_filename), timings
+
+# Job mode -> (render stage, output file name, what a row produces)
+RENDERERS = {
+    'full': (render_row, "video_{}.mp4", "Video"),
+    'preview': (render_preview_row, "preview_{}.jpg", "Preview"),
+}
+
+class RowScheduler:
+    """Shares one worker's fetch and render pools between its active jobs.
+
+    Pipelines queue rows whose media is ready with enqueue(); a dispatcher
+    thread submits them to the render pool whenever a slot is free, picking
+    the job to serve with _pick().
+    """
+    def __init__(self, workers=None, processes=1):
+        self.workers = workers or WORKER_CONCURRENCY
+        self.ffmpeg_threads = ffmpeg_thread_budget(self.workers, processes)
+        self.fetch_pool = make_fetch_pool(self.workers)
+        self.render_pool = make_render_pool(self.workers, self.ffmpeg_threads)
+        self.pipelines = {}  # job id -> RowPipeline
+        self.ready = {}      # job id -> rows waiting for a render slot
+        self.rendering = {}  # job id -> rows being rendered
+        self.served = {}     # job id -> when it last got a slot, for round robin between equals
+        self.dispatched = 0
+        self.running = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._dispatch, daemon=True, name='row-dispatcher')
+        self.thread.start()
+
+    def add(self, pipeline):
+        with self.cond:
+            self.pipelines[pipeline.job_id] = pipeline
+            self.ready[pipeline.job_id] = deque()
+            self.rendering[pipeline.job_id] = 0
+            self.served[pipeline.job_id] = 0
+
+    def reserve(self, job_id):
+        """Count a just-claimed job as wanting a render slot before its pipeline is added."""
+        with self.cond:
+            self.served.setdefault(job_id, 0)
+
+    def remove(self, job_id):
+        """Forget a job. Rows it still had waiting are dropped."""
+        with self.cond:
+            for table in (self.pipelines, self.ready, self.rendering, self.served):
+                table.pop(job_id, None)
+
+    def has_free_slot(self):
+        """True if a render slot is free that no active job is about to take.
+
+        Rows waiting for a slot and jobs that have not had a row rendered yet
+        (still reading or scraping) each count as taking one.
+        """
+        with self.cond:
+            starting = sum(1 for served in self.served.values() if not served)
+            waiting = sum(len(rows) for rows in self.ready.values())
+            return self.running + waiting + starting < self.workers
+
+    def enqueue(self, pipeline, row):
+        """Queue row, an (index, output_filename, profile, media) tuple, for rendering."""
+        if pipeline.cancelled.is_set():
+            pipeline._row_done()  # Another worker owns the job now
+            return
+        with self.cond:
+            if pipeline.job_id in self.ready:
+                self.ready[pipeline.job_id].append(row)
+                self.cond.notify_all()
+
+    def _pick(self):
+        """Job to render next: fewest rows left, preferring jobs under their quota."""
+        waiting = [job_id for job_id, rows in self.ready.items() if rows]
+        under_quota = [job_id for job_id in waiting if self.rendering[job_id] < JOB_RENDER_QUOTA]
+        return min(under_quota or waiting,
+                   key=lambda job_id: (self.pipelines[job_id].remaining(), self.served[job_id]))
+
+    def _dispatch(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.closed or (
+                    self.running < self.workers and any(self.ready.values())))
+                if self.closed:
+                    return
+                job_id = self._pick()
+                pipeline = self.pipelines[job_id]
+                row = self.ready[job_id].popleft()
+                cancelled = pipeline.cancelled.is_set()
+                if not cancelled:
+                    self.running += 1
+                    self.rendering[job_id] += 1
+                    self.dispatched += 1
+                    self.served[job_id] = self.dispatched
+            if cancelled:
+                pipeline._row_done()
+                continue
+            index, output_filename, profile_data, media = row
+            future = self._submit_render(pipeline.render, profile_data, output_filename, media)
+            future.add_done_callback(
+                lambda f, p=pipeline, i=index, o=output_filename: self._on_rendered(p, i, o, f))
+
+    def _submit_render(self, fn, *args):
+        try:
+            return self.render_pool.submit(fn, *args)
+        except BrokenProcessPool:
+            # A render process died; the rows it took down have failed, later ones get a new pool
+            print("Render pool broken, starting a new one")
+            self.render_pool = make_render_pool(self.workers, self.ffmpeg_threads)
+            return self.render_pool.submit(fn, *args)
+
+    def _on_rendered(self, pipeline, index, output_filename, future):
+        with self.cond:
+            self.running -= 1
+            if pipeline.job_id in self.rendering:
+                self.rendering[pipeline.job_id] -= 1
+            self.cond.notify_all()
+        pipeline._on_rendered(index, output_filename, future)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        self.fetch_pool.shutdown()
+        self.render_pool.shutdown()
+
+class RowPipeline:
+    """Feeds one job's rows through the scheduler's pools and tracks the results.
+
+    Completion is handled in future callbacks so per-row log lines appear as
+    rows finish, whatever the concurrency; created files are kept by row index
+    so they can be returned in sheet order.
+
+    Once cancelled is set (the job's lease was lost) no more rows are
+    fetched or rendered and no outcomes are recorded, since the worker that
+    took the job over is redoing them.
+    """
+    def __init__(self, job_id, job_output_dir, scheduler, mode='full', cancelled=None):
+        self.job_id = job_id
+        self.job_output_dir = job_output_dir
+        self.scheduler = scheduler
+        self.cancelled = cancelled or threading.Event()
+        self.render, self.output_name, self.label = RENDERERS[mode]
+        self.created = {}  # row index -> output path, including rows finished by an earlier run
+        self.timings = {}  # row index -> [(stage, seconds)] so far
+        self.profiles = {}  # row index -> profile being rendered, recorded with the row
+        self.size = None   # rows this run expects to process, if known
+        self.finished = 0
+        self.pending = 0
+        self.cond = threading.Condition()
+
+    def remaining(self):
+        """Rows this run has left, as far as is known; small jobs are scheduled first."""
+        if self.size is None:
+            return float('inf')
+        return max(self.size - self.finished, self.pending)
+
+    def submit_fetch(self, index, fn, *args, timings=()):
+        with self.cond:
+            # Keep only a few rows per job ahead of the renders, so a big sheet
+            # doesn't fill the pools while smaller jobs wait
+            self.cond.wait_for(lambda: self.pending < ROW_READ_AHEAD or self.cancelled.is_set())
+            if self.cancelled.is_set():
+                return
+            self.pending += 1
+            self.timings[index] = list(timings)
+        future = self.scheduler.fetch_pool.submit(fn, *args)
+        future.add_done_callback(lambda f: self._on_fetched(index, f))
+
+    def _on_fetched(self, index, future):
+        try:
+            profile_data, media, timings = future.result()
+            self._add_timings(index, timings)
+            if not profile_data:
+                print(f"Skipping row {index}: Scraper returned no data.")
+                self._record(index, 'FAILED', error="Scraper returned no data")
+                self._row_done()
+                return
+            with self.cond:
+                self.profiles[index] = profile_data
+            output_filename = os.path.join(self.job_output_dir, self.output_name.format(index))
+            self.scheduler.enqueue(self, (index, output_filename, profile_data, media))
+        except Exception as e:
+            update_job_log(self.job_id, f"✗ Error processing row {index}: {str(e)}")
+            self._record(index, 'FAILED', error=str(e))
+            self._row_done()
+
+    def _on_rendered(self, index, output_filename, future):
+        with self.cond:
+            profile = self.profiles.pop(index, None)
+        try:
+            ok, timings = future.result()
+            self._add_timings(index, timings)
+            if ok:
+                self.created[index] = output_filename
+                self._record(index, 'DONE', output_filename, profile=profile)
+                update_job_log(self.job_id, f"✓ {self.label} created for row {index}")
+            else:
+                self._record(index, 'FAILED', error=f"{self.label} failed", profile=profile)
+                update_job_log(self.job_id, f"✗ {self.label} failed for row {index}")
+        except Exception as e:
+            update_job_log(self.job_id, f"✗ Error processing row {index}: {str(e)}")
+            self._record(index, 'FAILED', error=str(e), profile=profile)
+        finally:
+            self._row_done()
+
+    def _add_timings(self, index, timings):
+        with self.cond:
+            self.timings.setdefault(index, []).extend(timings)
+
+    def _take_timings(self, index):
+        with self.cond:
+            return self.timings.pop(index, [])
+
+    def _record(self, index, status, output_path=None, error=None, profile=None):
+        timings = self._take_timings(index)
+        if not self.cancelled.is_set():
+            jobstore.record_row(self.job_id, index, status, output_path, error, timings, profile)
 
-def process_job(job_id, input_file):
+    def _row_done(self):
+        with self.cond:
+            self.pending -= 1
+            self.finished += 1
+            self.cond.notify_all()
+
+    def wait(self):
+        # Renders are submitted from fetch callbacks, so futures alone can't
+        # tell when a row is finished; count rows instead.
+        with self.cond:
+            self.cond.wait_for(lambda: self.pending == 0)
+        return [self.created[index] for index in sorted(self.created)]
+
+def build_format2_profile(row):
+    def field(column, default="N/A"):
+        value = row.get(column)
+        return default if value is None else value
+
+    return {
+        "profile_name": field("Profile Name"),
+        "age": str(field("Age")),
+        "marital_status": field("Marital Status"),
+        "mother_tongue": field("Mother Toungue"),
+        "religion": field("Religion"),
+        "country": field("Country"),
+        "education": field("Education"),
+        "occupation": field("Occupation"),
+        "about": field("Profile description"),
+        "profile_picture": row.get("Photos URL"),
+        "background_music_url": row.get("Background music URL"),
+        "additional_data": {
+            "profile_url": "No URL Provided",
+            "star_sign": "", 
+            "food_habit": "",
+            "smoking_habit": "",
+            "drinking_habit": ""
+        }
+    }
+
+def count_rows(rows, counter):
+    """Pass (index, record) pairs through, counting them in counter['count']."""
+    for index, row in rows:
+        counter['count'] += 1
+        yield index, row
+
+def process_job(job_id, input_file, scheduler=None, mode='full', preview_of=None, cancelled=None):
     update_job_log(job_id, f"Started processing job {job_id}")
     
-    # Create a temp working dir for this job's videos
+    # Create the dir that holds this job's videos
     job_output_dir = os.path.join(OUTPUT_FOLDER, job_id)
     os.makedirs(job_output_dir, exist_ok=True)
     
     video_files_created = []
+    own_scheduler = scheduler is None
+    if own_scheduler:
+        scheduler = RowScheduler()
+    pipeline = RowPipeline(job_id, job_output_dir, scheduler, mode, cancelled)
+    scheduler.add(pipeline)
     
     try:
-        df = pd.read_excel(input_file)
-        total_rows = len(df)
-        update_job_log(job_id, f"Found {total_rows} profiles to process")
+        # Rows are streamed from the file, so work on the first rows starts
+        # while the rest of a large sheet is still being read.
+        columns, total_rows, rows = read_sheet(input_file)
+        if total_rows is not None:
+            update_job_log(job_id, f"Found {total_rows} profiles to process")
+        total_label = total_rows if total_rows is not None else '?'
+        if scheduler.workers > 1:
+            update_job_log(job_id, f"Parallel mode: {scheduler.workers} render workers")
+        if mode == 'preview':
+            update_job_log(job_id, "Preview mode: rendering contact sheets, no videos")
+        
+        # Rows finished by an earlier attempt at this job are not redone, and
+        # a job promoted from a preview reuses the profiles the preview found
+        db = get_db()
+        try:
+            jobstore.set_total_rows(db, job_id, total_rows)
+            pipeline.created.update(jobstore.completed_rows(db, job_id))
+            stored = jobstore.row_profiles(db, preview_of) if preview_of else {}
+        finally:
+            db.close()
+        if preview_of:
+            update_job_log(job_id, f"Promoted from preview {preview_of}: reusing {len(stored)} profiles")
+        rows_read = {'count': 0}
+        rows = count_rows(rows, rows_read)
+        if pipeline.created:
+            update_job_log(job_id, f"Resuming: {len(pipeline.created)} rows already rendered")
+        size = total_rows if total_rows is not None else estimate_rows(input_file)
+        if size is not None:
+            pipeline.size = max(size - len(pipeline.created), 0)
         
         # --- Format 1: URLs ---
-        if 'Profile url' in df.columns:
+        if 'Profile url' in columns:
             update_job_log(job_id, "Detected Format 1: Scraping URLs...")
             
-            for index, row in df.iterrows():
-                profile_url = row['Profile url']
-                music_url = row.get('Background music URL')
-                update_job_log(job_id, f"[{index+1}/{total_rows}] Scraping {profile_url}...")
-                
-                try:
-                    profile_data = get_profile_data(profile_url)
-                    
-                    if not profile_data:
-                        print(f"Skipping row {index}: Scraper returned no data.")
+            todo = []  # (index, row) for each URL handed to the scraper, in order
+
+            def pending_urls():
+                for index, row in rows:
+                    if pipeline.cancelled.is_set():
+                        return
+                    if index in pipeline.created:
                         continue
-                    
-                    if music_url:
-                        profile_data['background_music_url'] = music_url
-                    
-                    output_filename = os.path.join(job_output_dir, f"video_{index}.mp4")
-                    generate_video_from_profile(profile_data, output_filename)
-                    
-                    if os.path.exists(output_filename):
-                        video_files_created.append(output_filename)
-                        update_job_log(job_id, f"✓ Video created for row {index}")
-                    else:
-                        update_job_log(job_id, f"✗ Video failed for row {index}")
-                    
-                except Exception as e:
-                    update_job_log(job_id, f"✗ Error processing row {index}: {str(e)}")
+                    if index in stored:
+                        pipeline.submit_fetch(index, fetch_media, stored[index])
+                        continue
+                    if not row.get('Profile url'):
+                        update_job_log(job_id, f"✗ Row {index} has no profile URL")
+                        jobstore.record_row(job_id, index, 'FAILED', error="No profile URL")
+                        continue
+                    todo.append((index, row))
+                    yield row['Profile url']
+            
+            # Pages are fetched concurrently; each row starts rendering as
+            # soon as its own page has been scraped.
+            scrape_timings = {}
+            cache_counts = {'hits': 0, 'revalidated': 0, 'misses': 0}
+            for n, profile_data in get_profiles_data(pending_urls(), timings=scrape_timings,
+                                                     cache_counts=cache_counts):
+                index, row = todo[n]
+                update_job_log(job_id, f"[{index+1}/{total_label}] Scraped {row['Profile url']}")
+                if profile_data and row.get('Background music URL'):
+                    profile_data['background_music_url'] = row['Background music URL']
+                pipeline.submit_fetch(index, fetch_media, profile_data, timings=scrape_timings.pop(n, ()))
+            
+            update_job_log(job_id, f"Page cache: {cache_counts['hits']} hits, "
+                                   f"{cache_counts['revalidated']} revalidated, {cache_counts['misses']} misses")
 
         # --- Format 2: Direct Data ---
-        elif 'Profile Name' in df.columns:
+        elif 'Profile Name' in columns:
             update_job_log(job_id, "Detected Format 2: Using direct data...")
             
-            for index, row in df.iterrows():
-                update_job_log(job_id, f"[{index+1}/{total_rows}] Processing: {row.get('Profile Name', 'Unknown')}")
+            for index, row in rows:
+                if pipeline.cancelled.is_set():
+                    break
+                if index in pipeline.created:
+                    continue
+                update_job_log(job_id, f"[{index+1}/{total_label}] Processing: {row.get('Profile Name') or 'Unknown'}")
                 try:
-                    profile_data = {
-                        "profile_name": row.get("Profile Name", "N/A"),
-                        "age": str(row.get("Age", "N/A")),
-                        "marital_status": row.get("Marital Status", "N/A"),
-                        "mother_tongue": row.get("Mother Toungue", "N/A"),
-                        "religion": row.get("Religion", "N/A"),
-                        "country": row.get("Country", "N/A"),
-                        "education": row.get("Education", "N/A"),
-                        "occupation": row.get("Occupation", "N/A"),
-                        "about": row.get("Profile description", "N/A"),
-                        "profile_picture": row.get("Photos URL"),
-                        "background_music_url": row.get("Background music URL"),
-                        "additional_data": {
-                            "profile_url": "No URL Provided",
-                            "star_sign": "", 
-                            "food_habit": "",
-                            "smoking_habit": "",
-                            "drinking_habit": ""
-                        }
-                    }
-                    
-                    output_filename = os.path.join(job_output_dir, f"video_{index}.mp4")
-                    generate_video_from_profile(profile_data, output_filename)
-                    
-                    if os.path.exists(output_filename):
-                        video_files_created.append(output_filename)
-                        update_job_log(job_id, f"✓ Video created for row {index}")
-                    else:
-                        update_job_log(job_id, f"✗ Video failed for row {index}")
-
+                    profile_data = stored.get(index) or build_format2_profile(row)
+                    pipeline.submit_fetch(index, fetch_media, profile_data)
                 except Exception as e:
                     update_job_log(job_id, f"✗ Error processing row {index}: {str(e)}")
+                    jobstore.record_row(job_id, index, 'FAILED', error=str(e))
+
+        if rows_read['count'] != total_rows and not pipeline.cancelled.is_set():
+            # CSV has no row count up front, and xlsx dimensions include blank rows
+            db = get_db()
+            try:
+                jobstore.set_total_rows(db, job_id, rows_read['count'])
+            finally:
+                db.close()
+
+        video_files_created = pipeline.wait()
+        if pipeline.cancelled.is_set():
+            update_job_log(job_id, "Lost the lease on this job; stopped and left the remaining rows to the worker that took it over")
+            return "FAILED", None
 
         # --- Finalize ---
+        # Videos stay as per-row files; /download streams them as a ZIP
         if video_files_created:
-            zip_filename = f"{job_id}.zip"
-            zip_filepath = os.path.join(OUTPUT_FOLDER, zip_filename)
-            
-            update_job_log(job_id, f"Zipping {len(video_files_created)} videos...")
-            with zipfile.ZipFile(zip_filepath, 'w') as zf:
-                for file in video_files_created:
-                    zf.write(file, os.path.basename(file))
-            
-            shutil.rmtree(job_output_dir) # Cleanup raw videos
-            update_job_log(job_id, "Job completed successfully!")
-            return "COMPLETED", zip_filepath
+            update_job_log(job_id, f"Job completed successfully! {len(video_files_created)} "
+                                   f"{pipeline.label.lower()}s ready.")
+            return "COMPLETED", job_output_dir
         else:
             update_job_log(job_id, "No videos created - job failed")
             return "FAILED", None
@@ -137,34 +487,101 @@ def process_job(job_id, input_file):
     except Exception as e:
         print(f"Job {job_id} failed: {e}")
         return "FAILED", None
+    finally:
+        scheduler.remove(job_id)
+        if own_scheduler:
+            scheduler.close()
+        jobstore.flush_job_logs()
+
+# --- Job Queue ---
+POLL_INTERVAL = 5  # Seconds between queue checks when idle and not woken
+# A worker with every render slot taken leaves new jobs to idle workers and
+# only takes one nobody has claimed for this long
+CLAIM_GRACE = int(os.environ.get('WORKER_CLAIM_GRACE', str(POLL_INTERVAL * 2)))
 
-def process_jobs():
-    """Process all pending jobs once"""
+def default_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def run_job(job, worker_id, scheduler, job_slots):
+    """Process a claimed job under its lease, then record how it ended."""
+    job_id = job['id']
     try:
-        db = get_db()
-        jobs = db.execute('SELECT * FROM jobs WHERE status = ?', ('PENDING',)).fetchall()
+        with jobstore.LeaseKeeper(job_id, worker_id) as lease:
+            status, output_path = process_job(job_id, job['input_file'], scheduler, job['mode'],
+                                              job['preview_of'], lease.lost)
         
-        for job in jobs:
-            job_id = job['id']
-            input_file = job['input_file']
-            
-            db.execute('UPDATE jobs SET status = ? WHERE id = ?', ('PROCESSING', job_id))
-            db.commit()
-            
-            status, output_path = process_job(job_id, input_file)
-            
-            db.execute('UPDATE jobs SET status = ?, output_file = ? WHERE id = ?', (status, output_path, job_id))
-            db.commit()
-        
-        db.close()
+        db = get_db()
+        try:
+            jobstore.finish_job(db, job_id, worker_id, status, output_path)
+        finally:
+            db.close()
+    except Exception as e:
+        print(f"Worker error on job {job_id}: {e}")
+    finally:
+        scheduler.remove(job_id)
+        job_slots.release()
+
+def process_jobs(worker_id, scheduler, job_slots):
+    """Claim jobs until the queue is empty, running each in its own thread.
+
+    Blocks while MAX_ACTIVE_JOBS jobs (the job_slots semaphore) are running.
+    While no render slot is free, only jobs left unclaimed for CLAIM_GRACE
+    seconds are taken, so with several worker processes an idle one gets
+    them first.
+    """
+    try:
+        db = get_db()
+        try:
+            while True:
+                job_slots.acquire()
+                try:
+                    min_wait = 0 if scheduler.has_free_slot() else CLAIM_GRACE
+                    job = jobstore.claim_job(db, worker_id, min_wait)
+                except Exception:
+                    job_slots.release()
+                    raise
+                if job is None:
+                    job_slots.release()
+                    break
+                scheduler.reserve(job['id'])
+                threading.Thread(target=run_job, args=(job, worker_id, scheduler, job_slots),
+                                 daemon=True, name=f"job-{job['id']}").start()
+        finally:
+            db.close()
     except Exception as e:
         print(f"Worker error: {e}")
 
-def main_worker_loop():
-    print("Worker loop started. Waiting for jobs...")
+def main_worker_loop(worker_id=None, processes=1):
+    worker_id = worker_id or default_worker_id()
+    scheduler = RowScheduler(processes=processes)
+    job_slots = threading.BoundedSemaphore(MAX_ACTIVE_JOBS)
+    # Keeps the disk within quota; of all the workers sharing jobs.db, one runs each pass
+    storage.start_maintenance()
+    print(f"Worker {worker_id} started ({scheduler.workers} render slots, up to {MAX_ACTIVE_JOBS} jobs at once, "
+          f"{scheduler.ffmpeg_threads} ffmpeg threads per encode). Waiting for jobs...")
     while True:
-        process_jobs()
-        time.sleep(5)
+        process_jobs(worker_id, scheduler, job_slots)
+        jobstore.wait_for_work(POLL_INTERVAL)
+
+def run_worker_processes(count):
+    """Run count independent queue workers, one per process."""
+    procs = [multiprocessing.Process(target=main_worker_loop, kwargs={'processes': count}, name=f'worker-{i}')
+             for i in range(count)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
 
 if __name__ == "__main__":
-    main_worker_loop()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Process queued video jobs.")
+    parser.add_argument('--processes', type=int, default=1, help="number of worker processes to run")
+    args = parser.parse_args()
+    
+    db = get_db()
+    jobstore.init_schema(db)
+    db.close()
+    
+    if args.processes > 1:
+        run_worker_processes(args.processes)
+    else:
+        main_worker_loop()